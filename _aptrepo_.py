@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+import sys
+import re
+import os
+import gzip
+import lzma
+import bz2
+import hashlib
+import time
+import email.utils
+import subprocess
+import tempfile
+
+__description__ = "Read and write APT repository indexes for 'choopsit/servers'"
+__author__ = "Choops <choopsbd@gmail.com>"
+
+
+def usage():
+    myscript = f"{os.path.basename(sys.argv[0])}"
+    print(f"{ci}{__description__}\nUsage{c0}:")
+    print(f"  ./{myscript} [OPTION] <INDEX>")
+    print(f"  print package names and versions of a Packages INDEX")
+    print(f"{ci}Options{c0}:")
+    print(f"  -h,--help: Print this help")
+    print()
+
+
+def parse_paragraphs(text):
+    paragraphs = []
+
+    paragraph = {}
+    key = None
+    for line in text.split("\n"):
+        if line.strip() == "":
+            if paragraph != {}:
+                paragraphs.append(paragraph)
+            paragraph = {}
+            key = None
+        elif line[0] in [" ", "\t"]:
+            if key is not None:
+                paragraph[key] += f"\n{line}"
+        elif ":" in line:
+            key, val = line.split(":", 1)
+            paragraph[key] = val.strip()
+
+    if paragraph != {}:
+        paragraphs.append(paragraph)
+
+    return paragraphs
+
+
+def format_paragraph(paragraph):
+    text = ""
+    for key, val in paragraph.items():
+        if val.startswith("\n"):
+            text += f"{key}:{val}\n"
+        else:
+            text += f"{key}: {val}\n"
+
+    return text
+
+
+def release_checksums(release, field="SHA256"):
+    checksums = {}
+
+    for line in release.get(field, "").split("\n"):
+        fields = line.split()
+        if len(fields) == 3:
+            checksums[fields[2]] = [fields[0], int(fields[1])]
+
+    return checksums
+
+
+def read_index(path):
+    if path.endswith(".xz"):
+        opener = lzma.open
+    elif path.endswith(".gz"):
+        opener = gzip.open
+    elif path.endswith(".bz2"):
+        opener = bz2.open
+    else:
+        opener = open
+
+    with opener(path, "rb") as f:
+        return f.read().decode("utf-8", "replace")
+
+
+def write_index(path, text, byhash=False):
+    data = text.encode()
+    variants = {path: data, f"{path}.gz": gzip.compress(data, mtime=0),
+                f"{path}.xz": lzma.compress(data)}
+    hashfolder = f"{os.path.dirname(path)}/by-hash/SHA256"
+
+    for variant, content in variants.items():
+        with open(f"{variant}.tmp", "wb") as f:
+            f.write(content)
+        if byhash:
+            os.makedirs(hashfolder, exist_ok=True)
+            hashfile = f"{hashfolder}/{hashlib.sha256(content).hexdigest()}"
+            if not os.path.exists(hashfile):
+                os.link(f"{variant}.tmp", hashfile)
+
+    for variant in variants:
+        os.replace(f"{variant}.tmp", variant)
+
+    return list(variants)
+
+
+def prune_byhash(indexfolder, keep):
+    hashfolder = f"{indexfolder}/by-hash/SHA256"
+    if not os.path.isdir(hashfolder):
+        return
+
+    current = set()
+    for item in os.listdir(indexfolder):
+        if os.path.isfile(f"{indexfolder}/{item}"):
+            current.add(os.stat(f"{indexfolder}/{item}").st_ino)
+
+    hashfiles = []
+    for item in os.listdir(hashfolder):
+        itemstat = os.stat(f"{hashfolder}/{item}")
+        if itemstat.st_ino not in current:
+            hashfiles.append([itemstat.st_mtime, f"{hashfolder}/{item}"])
+
+    for _, hashfile in sorted(hashfiles, reverse=True)[keep:]:
+        os.remove(hashfile)
+
+
+def ed_diff(oldtext, newtext):
+    with tempfile.TemporaryDirectory() as tmpfolder:
+        for name, text in [["old", oldtext], ["new", newtext]]:
+            with open(f"{tmpfolder}/{name}", "w") as f:
+                f.write(text)
+        diffcmd = ["diff", "--ed", f"{tmpfolder}/old", f"{tmpfolder}/new"]
+        diff = subprocess.run(diffcmd, capture_output=True)
+
+    if diff.returncode not in [0, 1]:
+        return None
+
+    return diff.stdout
+
+
+def read_pdiff_index(pdifffolder):
+    history = {"SHA256-History": [], "SHA256-Patches": [],
+               "SHA256-Download": []}
+
+    if not os.path.isfile(f"{pdifffolder}/Index"):
+        return history
+
+    with open(f"{pdifffolder}/Index", "r") as f:
+        paragraphs = parse_paragraphs(f.read())
+    if paragraphs == []:
+        return history
+
+    for field in history:
+        for line in paragraphs[0].get(field, "").split("\n"):
+            if len(line.split()) == 3:
+                history[field].append(line.split())
+
+    return history
+
+
+def update_pdiff(indexfolder, oldtext, newtext, keep):
+    pdifffolder = f"{indexfolder}/Packages.diff"
+    olddata = oldtext.encode()
+    newdata = newtext.encode()
+
+    history = read_pdiff_index(pdifffolder)
+    patch = ed_diff(oldtext, newtext)
+    if patch is None or len(patch) >= len(newdata):
+        history = {"SHA256-History": [], "SHA256-Patches": [],
+                   "SHA256-Download": []}
+    else:
+        patchname = time.strftime("%Y-%m-%d-%H%M.%S", time.gmtime())
+        while any([p[2] == patchname for p in history["SHA256-Patches"]]):
+            patchname += "x"
+        patchgz = gzip.compress(patch, mtime=0)
+        os.makedirs(pdifffolder, exist_ok=True)
+        with open(f"{pdifffolder}/{patchname}.gz", "wb") as f:
+            f.write(patchgz)
+
+        for field, data, name in [["SHA256-History", olddata, patchname],
+                                  ["SHA256-Patches", patch, patchname],
+                                  ["SHA256-Download", patchgz,
+                                   f"{patchname}.gz"]]:
+            history[field].append([hashlib.sha256(data).hexdigest(),
+                                   str(len(data)), name])
+
+    for field in history:
+        history[field] = history[field][-keep:]
+
+    if not os.path.isdir(pdifffolder):
+        return []
+
+    kept = [entry[2] for entry in history["SHA256-Download"]]
+    for item in os.listdir(pdifffolder):
+        if item.endswith(".gz") and item not in kept:
+            os.remove(f"{pdifffolder}/{item}")
+
+    index = {"SHA256-Current": f"{hashlib.sha256(newdata).hexdigest()} "
+                               f"{len(newdata)}"}
+    for field, entries in history.items():
+        index[field] = ""
+        for sha256, size, name in entries:
+            index[field] += f"\n {sha256} {size:>8} {name}"
+
+    indexdata = format_paragraph(index).encode()
+    hashfolder = f"{pdifffolder}/by-hash/SHA256"
+    os.makedirs(hashfolder, exist_ok=True)
+    with open(f"{pdifffolder}/Index.tmp", "wb") as f:
+        f.write(indexdata)
+    hashfile = f"{hashfolder}/{hashlib.sha256(indexdata).hexdigest()}"
+    if not os.path.exists(hashfile):
+        os.link(f"{pdifffolder}/Index.tmp", hashfile)
+    os.replace(f"{pdifffolder}/Index.tmp", f"{pdifffolder}/Index")
+
+    return [f"{pdifffolder}/Index"]
+
+
+def file_hashes(path):
+    hashes = {"MD5Sum": hashlib.md5(), "SHA256": hashlib.sha256()}
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(hashchunk), b""):
+            for _, hashobj in hashes.items():
+                hashobj.update(chunk)
+
+    result = {}
+    for field, hashobj in hashes.items():
+        result[field] = hashobj.hexdigest()
+
+    return result, os.path.getsize(path)
+
+
+def write_release(distfolder, fields, indexes, hashcache=None):
+    release = dict(fields)
+    if "Date" not in release:
+        release["Date"] = email.utils.formatdate(usegmt=True)
+    for field in ["MD5Sum", "SHA256"]:
+        release[field] = ""
+
+    for index in sorted(indexes):
+        path = f"{distfolder}/{index}"
+        if hashcache is not None and index in hashcache:
+            hashes, size = hashcache[index]
+        else:
+            hashes, size = file_hashes(path)
+        for field in ["MD5Sum", "SHA256"]:
+            release[field] += f"\n {hashes[field]} {size:>16} {index}"
+
+    with open(f"{distfolder}/Release.tmp", "w") as f:
+        f.write(format_paragraph(release))
+    os.replace(f"{distfolder}/Release.tmp", f"{distfolder}/Release")
+
+
+def sign_release(distfolder, keyid, passfile=None):
+    gpgcmd = ["gpg", "--batch", "--yes", "--default-key", keyid]
+    if passfile:
+        gpgcmd += ["--pinentry-mode", "loopback", "--passphrase-file",
+                   passfile]
+
+    release = f"{distfolder}/Release"
+    for signopts, signfile in [[["--clearsign"], "InRelease"],
+                               [["--armor", "--detach-sign"], "Release.gpg"]]:
+        signcmd = gpgcmd + signopts + ["-o", f"{distfolder}/{signfile}.tmp",
+                                       release]
+        if subprocess.run(signcmd, stdout=subprocess.DEVNULL).returncode != 0:
+            print(f"{error} Failed to sign '{release}' with key '{keyid}'")
+            return False
+        os.replace(f"{distfolder}/{signfile}.tmp",
+                   f"{distfolder}/{signfile}")
+
+    return True
+
+
+def package_relations(paragraph, fields=("Pre-Depends", "Depends")):
+    relations = []
+
+    for field in fields:
+        for group in paragraph.get(field, "").split(","):
+            alternatives = []
+            for alternative in group.split("|"):
+                name = re.sub(r'[\(\[<].*', "", alternative).strip()
+                name = name.split(":")[0]
+                if name != "":
+                    alternatives.append(name)
+            if alternatives != []:
+                relations.append(alternatives)
+
+    return relations
+
+
+def split_version(version):
+    epoch, revision = "0", "0"
+    if ":" in version:
+        epoch, version = version.split(":", 1)
+    if "-" in version:
+        version, revision = version.rsplit("-", 1)
+
+    return int(epoch or 0), version, revision
+
+
+def compare_part(left, right):
+    def order(char):
+        if char == "~":
+            return -1
+        if char.isalpha():
+            return ord(char)
+        return ord(char) + 256
+
+    while left != "" or right != "":
+        lhead = re.match(r'^[^0-9]*', left).group()
+        rhead = re.match(r'^[^0-9]*', right).group()
+        for lchar, rchar in zip(lhead + "\0" * len(rhead),
+                                rhead + "\0" * len(lhead)):
+            lorder = 0 if lchar == "\0" else order(lchar)
+            rorder = 0 if rchar == "\0" else order(rchar)
+            if lorder != rorder:
+                return -1 if lorder < rorder else 1
+        left, right = left[len(lhead):], right[len(rhead):]
+
+        lnum = re.match(r'^[0-9]*', left).group()
+        rnum = re.match(r'^[0-9]*', right).group()
+        if int(lnum or 0) != int(rnum or 0):
+            return -1 if int(lnum or 0) < int(rnum or 0) else 1
+        left, right = left[len(lnum):], right[len(rnum):]
+
+    return 0
+
+
+def version_compare(left, right):
+    lepoch, lversion, lrevision = split_version(left)
+    repoch, rversion, rrevision = split_version(right)
+    if lepoch != repoch:
+        return -1 if lepoch < repoch else 1
+
+    return compare_part(lversion, rversion) or \
+        compare_part(lrevision, rrevision)
+
+
+c0 = "\33[0m"
+ce = "\33[31m"
+cok = "\33[32m"
+cw = "\33[33m"
+ci = "\33[36m"
+
+error = f"{ce}E{c0}:"
+done = f"{cok}OK{c0}:"
+warning = f"{cw}W{c0}:"
+
+hashchunk = 1024 * 1024
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or re.match('^-(h|-help)$', sys.argv[1]):
+        usage()
+        exit(0)
+
+    if not os.path.isfile(sys.argv[1]):
+        print(f"{error} '{sys.argv[1]}' does not exist")
+        exit(1)
+
+    for myparagraph in parse_paragraphs(read_index(sys.argv[1])):
+        if "Package" in myparagraph:
+            print(f"{myparagraph['Package']} "
+                  f"{myparagraph.get('Version', '')}")
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+import sys
+import re
+import os
+import struct
+
+__description__ = "Read and extract files from an ISO9660 image without mounting it"
+__author__ = "Choops <choopsbd@gmail.com>"
+
+
+def usage():
+    myscript = f"{os.path.basename(sys.argv[0])}"
+    print(f"{ci}{__description__}\nUsage{c0}:")
+    print(f"  ./{myscript} [OPTION] <ISO> [MEMBER [MEMBER...]] [TARGET]")
+    print(f"  with no MEMBER, list ISO content")
+    print(f"{ci}Options{c0}:")
+    print(f"  -h,--help: Print this help")
+    print()
+
+
+def read_sectors(isof, lba, length):
+    isof.seek(lba * sectorsize)
+
+    return isof.read(length)
+
+
+def volume_descriptors(isof):
+    pvd = None
+    joliet = None
+
+    lba = 16
+    while True:
+        vd = read_sectors(isof, lba, sectorsize)
+        if len(vd) < sectorsize or vd[1:6] != b"CD001":
+            break
+        if vd[0] == 1 and pvd is None:
+            pvd = vd
+        elif vd[0] == 2 and vd[88:91] in [b"%/@", b"%/C", b"%/E"]:
+            joliet = vd
+        elif vd[0] == 255:
+            break
+        lba += 1
+
+    if pvd is None:
+        raise ValueError("no ISO9660 primary volume descriptor")
+
+    return pvd, joliet
+
+
+def parse_record(record):
+    lba = struct.unpack_from("<I", record, 2)[0]
+    size = struct.unpack_from("<I", record, 10)[0]
+    flags = record[25]
+    namelen = record[32]
+    rawname = record[33:33 + namelen]
+
+    sysuse = 33 + namelen
+    if namelen % 2 == 0:
+        sysuse += 1
+
+    return lba, size, flags, rawname, record[sysuse:]
+
+
+def rockridge_name(sysuse):
+    name = b""
+    i = 0
+    while i + 4 <= len(sysuse):
+        sig = sysuse[i:i + 2]
+        entrylen = sysuse[i + 2]
+        if entrylen < 4:
+            break
+        if sig == b"NM":
+            nmflags = sysuse[i + 4]
+            if nmflags & 0x06 == 0:
+                name += sysuse[i + 5:i + entrylen]
+        elif sig == b"ST":
+            break
+        i += entrylen
+
+    if name == b"":
+        return None
+
+    return name.decode("utf-8", "replace")
+
+
+def record_name(rawname, sysuse, joliet):
+    if joliet:
+        return rawname.decode("utf-16-be", "replace").split(";")[0]
+
+    rrname = rockridge_name(sysuse)
+    if rrname is not None:
+        return rrname
+
+    name = rawname.decode("ascii", "replace").split(";")[0]
+    if name.endswith("."):
+        name = name[:-1]
+
+    return name.lower()
+
+
+def read_directory(isof, lba, size, joliet):
+    entries = {}
+
+    data = read_sectors(isof, lba, size)
+    offset = 0
+    while offset < len(data):
+        reclen = data[offset]
+        if reclen == 0:
+            offset = (offset // sectorsize + 1) * sectorsize
+            continue
+
+        record = data[offset:offset + reclen]
+        offset += reclen
+
+        extlba, extsize, flags, rawname, sysuse = parse_record(record)
+        if rawname in [b"\x00", b"\x01"]:
+            continue
+
+        name = record_name(rawname, sysuse, joliet)
+        isdir = bool(flags & 0x02)
+        if name in entries and not isdir:
+            entries[name][1].append([extlba, extsize])
+        else:
+            entries[name] = [isdir, [[extlba, extsize]]]
+
+    return entries
+
+
+def root_directory(isof):
+    pvd, joliet = volume_descriptors(isof)
+
+    lba, size, _, _, _ = parse_record(pvd[156:190])
+    firstrecord = read_sectors(isof, lba, sectorsize)
+    _, _, _, _, rootsysuse = parse_record(firstrecord[:firstrecord[0]])
+    if rootsysuse[:2] == b"SP" or joliet is None:
+        return lba, size, False
+
+    lba, size, _, _, _ = parse_record(joliet[156:190])
+
+    return lba, size, True
+
+
+def find_member(isof, member):
+    lba, size, joliet = root_directory(isof)
+
+    isdir = True
+    extents = [[lba, size]]
+    for part in member.strip("/").split("/"):
+        if not isdir:
+            return None
+        entries = read_directory(isof, extents[0][0], extents[0][1], joliet)
+        if part not in entries:
+            return None
+        isdir, extents = entries[part]
+
+    if isdir:
+        return None
+
+    return extents
+
+
+def list_members(isof, lba=None, size=None, joliet=None, prefix=""):
+    members = []
+
+    if lba is None:
+        lba, size, joliet = root_directory(isof)
+
+    entries = read_directory(isof, lba, size, joliet)
+    for name, val in sorted(entries.items()):
+        if val[0]:
+            members += list_members(isof, val[1][0][0], val[1][0][1], joliet,
+                                    f"{prefix}{name}/")
+        else:
+            members.append(f"{prefix}{name}")
+
+    return members
+
+
+def copy_extent(isofd, outfd, offset, length):
+    while length > 0:
+        count = min(length, copychunk)
+        try:
+            copied = os.copy_file_range(isofd, outfd, count, offset)
+        except (AttributeError, OSError):
+            copied = 0
+
+        if copied == 0:
+            data = os.pread(isofd, count, offset)
+            if not data:
+                raise ValueError("unexpected end of ISO image")
+            copied = os.write(outfd, data)
+
+        offset += copied
+        length -= copied
+
+
+def extract(isopath, members, tgtfolder):
+    extracted = []
+
+    with open(isopath, "rb") as isof:
+        for member in members:
+            extents = find_member(isof, member)
+            if extents is None:
+                print(f"{error} '{member}' not found in '{isopath}'")
+                continue
+
+            tgt = f"{tgtfolder}/{member.strip('/')}"
+            os.makedirs(os.path.dirname(tgt), exist_ok=True)
+            with open(tgt, "wb") as outf:
+                for lba, size in extents:
+                    copy_extent(isof.fileno(), outf.fileno(),
+                                lba * sectorsize, size)
+            extracted.append(tgt)
+
+    return extracted
+
+
+c0 = "\33[0m"
+ce = "\33[31m"
+cok = "\33[32m"
+cw = "\33[33m"
+ci = "\33[36m"
+
+error = f"{ce}E{c0}:"
+done = f"{cok}OK{c0}:"
+warning = f"{cw}W{c0}:"
+
+sectorsize = 2048
+copychunk = 16 * 1024 * 1024
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or re.match('^-(h|-help)$', sys.argv[1]):
+        usage()
+        exit(0)
+
+    myiso = sys.argv[1]
+    if not os.path.isfile(myiso):
+        print(f"{error} '{myiso}' does not exist")
+        exit(1)
+
+    if len(sys.argv) == 2:
+        with open(myiso, "rb") as myisof:
+            for mymember in list_members(myisof):
+                print(mymember)
+    elif len(sys.argv) == 3:
+        print(f"{error} No target folder given")
+        usage()
+        exit(1)
+    else:
+        for myfile in extract(myiso, sys.argv[2:-1], sys.argv[-1]):
+            print(f"{done} {myfile}")
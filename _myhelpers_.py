@@ -7,7 +7,15 @@ import socket
 import struct
 import fcntl
 import shutil
+import hashlib
+import json
+import time
+import threading
+import ctypes
+import csv
 import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
 
 __description__ = "Usefull functions for 'choopsit/servers'"
 __author__ = "Choops <choopsbd@gmail.com>"
@@ -340,12 +348,497 @@ def overwrite(src, tgt):
         shutil.copy(src, tgt, follow_symlinks=False)
 
 
+def url_info(url):
+    request = urllib.request.Request(url, method="HEAD")
+    try:
+        with urllib.request.urlopen(request, timeout=dltimeout) as resp:
+            size = int(resp.headers.get("Content-Length", 0))
+            ranges = resp.headers.get("Accept-Ranges", "") == "bytes"
+            finalurl = resp.geturl()
+    except (OSError, ValueError):
+        return url, 0, False
+
+    return finalurl, size, ranges
+
+
+def part_validator(resp):
+    etag = resp.headers.get("ETag", "")
+    if etag != "" and not etag.startswith("W/"):
+        return etag
+
+    return resp.headers.get("Last-Modified", "")
+
+
+def discard_part(tgt):
+    for partfile in [tgt, f"{tgt}.validator"]:
+        if os.path.isfile(partfile):
+            os.remove(partfile)
+
+
+def fetch_range(url, tgt, start=0, end=None):
+    done = 0
+    validator = ""
+    if os.path.isfile(tgt):
+        done = os.path.getsize(tgt)
+        if os.path.isfile(f"{tgt}.validator"):
+            with open(f"{tgt}.validator", "r") as f:
+                validator = f.read().strip()
+        if done > 0 and validator == "":
+            discard_part(tgt)
+            done = 0
+
+    if end is not None and start + done > end:
+        return
+
+    request = urllib.request.Request(url)
+    if start + done > 0 or end is not None:
+        brange = f"bytes={start + done}-"
+        if end is not None:
+            brange += f"{end}"
+        request.add_header("Range", brange)
+    if done > 0:
+        request.add_header("If-Range", validator)
+
+    try:
+        resp = urllib.request.urlopen(request, timeout=dltimeout)
+    except urllib.error.HTTPError as err:
+        if err.code == 416 and end is None:
+            return
+        raise
+
+    with resp:
+        mode = "ab"
+        if resp.status != 206:
+            if end is not None or start > 0:
+                discard_part(tgt)
+                raise OSError(f"'{url}' changed or does not support ranges")
+            mode = "wb"
+        with open(f"{tgt}.validator", "w") as f:
+            f.write(part_validator(resp))
+        with open(tgt, mode) as f:
+            while True:
+                chunk = resp.read(dlchunk)
+                if not chunk:
+                    break
+                f.write(chunk)
+
+
+def fetch_segments(url, tgt, size, segments):
+    seglen = size // segments + 1
+    segfiles = []
+    bounds = []
+    for i in range(segments):
+        start = i * seglen
+        end = min(start + seglen, size) - 1
+        segfiles.append(f"{tgt}.seg{i}")
+        bounds.append([start, end])
+
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        jobs = []
+        for i in range(segments):
+            jobs.append(pool.submit(fetch_range, url, segfiles[i],
+                                    bounds[i][0], bounds[i][1]))
+        for job in jobs:
+            job.result()
+
+    validators = set()
+    for segfile in segfiles:
+        with open(f"{segfile}.validator", "r") as f:
+            validators.add(f.read().strip())
+    if len(validators) != 1:
+        for segfile in segfiles:
+            discard_part(segfile)
+        raise OSError(f"'{url}' changed during download")
+
+    with open(tgt, "wb") as f:
+        for segfile in segfiles:
+            with open(segfile, "rb") as segf:
+                shutil.copyfileobj(segf, f, dlchunk)
+            discard_part(segfile)
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(dlchunk), b""):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def fetch_sha256(sumurl, filename):
+    try:
+        with urllib.request.urlopen(sumurl, timeout=dltimeout) as resp:
+            sums = resp.read().decode("utf-8", "replace")
+    except OSError:
+        print(f"{error} Could not get checksums from '{sumurl}'")
+        return None
+
+    for line in sums.split("\n"):
+        fields = line.split()
+        if len(fields) < 2 or not re.match('^[0-9a-f]{64}$', fields[0]):
+            continue
+        sumfile = fields[-1].lstrip("*")
+        if sumfile == filename or sumfile.endswith(f"/{filename}"):
+            return fields[0]
+
+    print(f"{error} No checksum for '{filename}' in '{sumurl}'")
+
+    return None
+
+
+def download(url, tgt, sumurl=None, sumname=None, segments=1):
+    parttgt = f"{tgt}.part"
+
+    sha256 = None
+    if sumurl:
+        if sumname is None:
+            sumname = url.split("/")[-1]
+        sha256 = fetch_sha256(sumurl, sumname)
+        if sha256 is None:
+            return False
+
+    try:
+        finalurl, size, ranges = url_info(url)
+        if segments > 1 and ranges and size >= dlsegmentmin:
+            fetch_segments(finalurl, parttgt, size, segments)
+        else:
+            fetch_range(finalurl, parttgt)
+    except OSError as err:
+        print(f"{error} Failed to download '{url}': {err}")
+        return False
+
+    if sha256 and file_sha256(parttgt) != sha256:
+        print(f"{error} Checksum mismatch for '{url}'")
+        discard_part(parttgt)
+        return False
+
+    os.replace(parttgt, tgt)
+    if os.path.isfile(f"{parttgt}.validator"):
+        os.remove(f"{parttgt}.validator")
+
+    return True
+
+
+def cache_entry(url):
+    urlkey = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    entryfile = f"{cachefolder}/index/{urlkey}.json"
+
+    entry = {}
+    if os.path.isfile(entryfile):
+        with open(entryfile, "r") as f:
+            try:
+                entry = json.load(f)
+            except ValueError:
+                entry = {}
+
+    if entry and not os.path.isfile(
+            f"{cachefolder}/objects/{entry['sha256']}"):
+        entry = {}
+
+    return entryfile, entry
+
+
+def cache_revalidate(url, entry):
+    request = urllib.request.Request(url, method="HEAD")
+    if entry.get("etag"):
+        request.add_header("If-None-Match", entry["etag"])
+    if entry.get("lastmodified"):
+        request.add_header("If-Modified-Since", entry["lastmodified"])
+
+    try:
+        with urllib.request.urlopen(request, timeout=dltimeout) as resp:
+            etag = resp.headers.get("ETag")
+            lastmodified = resp.headers.get("Last-Modified")
+    except urllib.error.HTTPError as err:
+        if err.code == 304:
+            return True, entry.get("etag"), entry.get("lastmodified")
+        return None, None, None
+    except OSError:
+        return None, None, None
+
+    if etag and etag == entry.get("etag"):
+        return True, etag, lastmodified
+    if not etag and lastmodified and lastmodified == entry.get("lastmodified"):
+        return True, etag, lastmodified
+
+    return False, etag, lastmodified
+
+
+def cache_evict(keep):
+    objfolder = f"{cachefolder}/objects"
+    objects = []
+    total = 0
+    for obj in os.listdir(objfolder):
+        try:
+            objstat = os.stat(f"{objfolder}/{obj}")
+        except FileNotFoundError:
+            continue
+        objects.append([objstat.st_mtime, objstat.st_size, obj])
+        total += objstat.st_size
+
+    # objects looked up lately may still be read by other download workers
+    now = time.time()
+    for mtime, size, obj in sorted(objects):
+        if total <= cachemax:
+            break
+        if obj == keep or now - mtime < cachegrace:
+            continue
+        try:
+            os.remove(f"{objfolder}/{obj}")
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def cache_lookup(url):
+    for subfolder in ["index", "objects", "tmp"]:
+        os.makedirs(f"{cachefolder}/{subfolder}", exist_ok=True)
+
+    entryfile, entry = cache_entry(url)
+    if entry:
+        fresh, etag, lastmodified = cache_revalidate(url, entry)
+        if fresh is None:
+            print(f"{warning} '{url}' unreachable, using cached copy")
+        if fresh is not False:
+            objpath = f"{cachefolder}/objects/{entry['sha256']}"
+            with cachelock:
+                if os.path.isfile(objpath):
+                    os.utime(objpath)
+                    return entryfile, objpath, None, None
+    else:
+        _, etag, lastmodified = cache_revalidate(url, {})
+
+    return entryfile, None, etag, lastmodified
+
+
+def cache_store(url, entryfile, tmppath, sha256, etag, lastmodified):
+    objpath = f"{cachefolder}/objects/{sha256}"
+    with cachelock:
+        os.replace(tmppath, objpath)
+
+        entry = {"url": url, "sha256": sha256, "etag": etag,
+                 "lastmodified": lastmodified,
+                 "size": os.path.getsize(objpath)}
+        with open(f"{entryfile}.tmp", "w") as f:
+            json.dump(entry, f)
+        os.replace(f"{entryfile}.tmp", entryfile)
+
+        cache_evict(sha256)
+
+    return objpath
+
+
+def cached_download(url, sumurl=None, sumname=None, segments=1):
+    entryfile, objpath, etag, lastmodified = cache_lookup(url)
+    if objpath is not None:
+        return objpath
+
+    urlkey = entryfile.split("/")[-1][:-len(".json")]
+    tmptgt = f"{cachefolder}/tmp/{urlkey}"
+    if not download(url, tmptgt, sumurl, sumname, segments):
+        return None
+
+    return cache_store(url, entryfile, tmptgt, file_sha256(tmptgt), etag,
+                       lastmodified)
+
+
+def cached_stream(url, consumer, sumurl=None, sumname=None):
+    entryfile, objpath, etag, lastmodified = cache_lookup(url)
+    if objpath is None:
+        sha256 = None
+        if sumurl:
+            if sumname is None:
+                sumname = url.split("/")[-1]
+            sha256 = fetch_sha256(sumurl, sumname)
+            if sha256 is None:
+                return False
+
+        urlkey = entryfile.split("/")[-1][:-len(".json")]
+        tmptgt = f"{cachefolder}/tmp/{urlkey}.stream"
+        streamsha256 = hashlib.sha256()
+        try:
+            with urllib.request.urlopen(url, timeout=dltimeout) as resp, \
+                 open(tmptgt, "wb") as f:
+                for chunk in iter(lambda: resp.read(dlchunk), b""):
+                    f.write(chunk)
+                    streamsha256.update(chunk)
+            if sha256 and streamsha256.hexdigest() != sha256:
+                print(f"{error} Checksum mismatch for '{url}'")
+                return False
+            objpath = cache_store(url, entryfile, tmptgt,
+                                  streamsha256.hexdigest(), etag,
+                                  lastmodified)
+        except OSError as err:
+            print(f"{error} Failed to download '{url}': {err}")
+            return False
+        finally:
+            if os.path.exists(tmptgt):
+                os.remove(tmptgt)
+
+    # only verified cache objects reach the consumer, named by their digest
+    with open(objpath, "rb") as f:
+        consumer(f, os.path.basename(objpath))
+
+    return True
+
+
+def atomic_swap(newpath, path):
+    if not os.path.lexists(path):
+        os.rename(newpath, path)
+        return
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    renameat2 = getattr(libc, "renameat2", None)
+    swapped = False
+    if renameat2 is not None:
+        AT_FDCWD = -100
+        RENAME_EXCHANGE = 2
+        swapped = renameat2(AT_FDCWD, newpath.encode(), AT_FDCWD,
+                            path.encode(), RENAME_EXCHANGE) == 0
+
+    if not swapped:
+        os.rename(path, f"{newpath}.old")
+        os.rename(newpath, path)
+        newpath = f"{newpath}.old"
+
+    if os.path.isdir(newpath) and not os.path.islink(newpath):
+        shutil.rmtree(newpath)
+    else:
+        os.remove(newpath)
+
+
+def hardlink_dedupe(root, indexfile, minsize=4 * 1024):
+    index = {}
+    if os.path.isfile(indexfile):
+        with open(indexfile, "r") as f:
+            try:
+                index = json.load(f)
+            except ValueError:
+                index = {}
+
+    bysize = {}
+    for folder, _, files in os.walk(root):
+        for item in files:
+            if item.endswith(".dedupe"):
+                continue
+            path = os.path.join(folder, item)
+            pathstat = os.lstat(path)
+            if not os.path.isfile(path) or os.path.islink(path):
+                continue
+            if pathstat.st_size < minsize:
+                continue
+            bysize.setdefault(pathstat.st_size, []).append([path, pathstat])
+
+    newindex = {}
+    byhash = {}
+    for size, paths in bysize.items():
+        if len(paths) < 2:
+            continue
+        for path, pathstat in paths:
+            key = [pathstat.st_size, pathstat.st_mtime_ns, pathstat.st_ino]
+            if path in index and index[path][:3] == key:
+                sha256 = index[path][3]
+            else:
+                sha256 = file_sha256(path)
+            newindex[path] = key + [sha256]
+            metadata = [sha256, size, pathstat.st_dev, pathstat.st_mode,
+                        pathstat.st_uid, pathstat.st_gid]
+            byhash.setdefault(tuple(metadata), []).append([path, pathstat])
+
+    saved = 0
+    for _, paths in byhash.items():
+        paths.sort(key=lambda path: -path[1].st_nlink)
+        canonical, canonicalstat = paths[0]
+        for path, pathstat in paths[1:]:
+            if pathstat.st_ino == canonicalstat.st_ino:
+                continue
+            if os.path.lexists(f"{path}.dedupe"):
+                os.remove(f"{path}.dedupe")
+            os.link(canonical, f"{path}.dedupe")
+            os.replace(f"{path}.dedupe", path)
+            saved += pathstat.st_size
+            newstat = os.lstat(path)
+            newindex[path] = [newstat.st_size, newstat.st_mtime_ns,
+                              newstat.st_ino, newindex[canonical][3]]
+
+    os.makedirs(os.path.dirname(indexfile), exist_ok=True)
+    with open(f"{indexfile}.tmp", "w") as f:
+        json.dump(newindex, f)
+    os.replace(f"{indexfile}.tmp", indexfile)
+
+    return saved
+
+
+def write_if_changed(path, lines):
+    oldlines = []
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            oldlines = f.readlines()
+
+    if lines == oldlines:
+        return False
+
+    with open(f"{path}.tmp", "w") as f:
+        f.writelines(lines)
+    if os.path.isfile(path):
+        shutil.copymode(path, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+    return True
+
+
+def set_conf_value(conffile, key, value):
+    lines = []
+    found = False
+    if os.path.isfile(conffile):
+        with open(conffile, "r") as f:
+            for line in f:
+                if re.match(f'^{key}=', line):
+                    if not found:
+                        lines.append(f"{key}={value}\n")
+                    found = True
+                else:
+                    lines.append(line)
+
+    if not found:
+        lines.append(f"{key}={value}\n")
+
+    return write_if_changed(conffile, lines)
+
+
+def update_exports(exports, exportsfile="/etc/exports"):
+    lines = []
+    written = []
+    if os.path.isfile(exportsfile):
+        with open(exportsfile, "r") as f:
+            for line in f:
+                fields = line.split()
+                share = fields[0].strip('"') if fields != [] else ""
+                if share in exports:
+                    if share not in written:
+                        lines.append(f"{share} {exports[share]}\n")
+                        written.append(share)
+                else:
+                    lines.append(line)
+
+    for share, clientopts in exports.items():
+        if share not in written:
+            lines.append(f"{share} {clientopts}\n")
+
+    return write_if_changed(exportsfile, lines)
+
+
 def vimplug_install(homefolder):
     tgtfolder = f"{homefolder}/.vim/autoload"
     os.makedirs(tgtfolder)
     rawgiturl = "https://raw.githubusercontent.com/"
     plugurl = f"{rawgiturl}junegunn/vim-plug/master/plug.vim"
-    urllib.request.urlretrieve(plugurl, f"{tgtfolder}/plug.vim")
+    if not download(plugurl, f"{tgtfolder}/plug.vim"):
+        print(f"{error} Failed to install vim-plug in '{homefolder}'")
+        return False
+
+    return True
 
 
 def common_config():
@@ -388,9 +881,61 @@ def common_config():
     for conf in ["vim", "profile"]:
         overwrite(f"{srcfolder}/root/{conf}", f"/root/.{conf}")
 
-    vimplug_install("/root")
+    if vimplug_install("/root"):
+        os.system("vim +PlugInstall +qall && clear")
 
-    os.system("vim +PlugInstall +qall && clear")
+
+def read_conf(conffile, required=[], setup=None):
+    conf = {}
+
+    if not os.path.isfile(conffile):
+        if setup is None:
+            return conf
+        print(f"{error} '{conffile}' does not exist, run '{setup}' first")
+        exit(1)
+
+    with open(conffile, "r") as f:
+        for line in f:
+            if "=" in line and not line.startswith("#"):
+                key, val = line.strip().split("=", 1)
+                conf[key] = val
+
+    for key in required:
+        if key not in conf:
+            print(f"{error} No '{key}' in '{conffile}', run '{setup}' again")
+            exit(1)
+
+    return conf
+
+
+def link_srcfolder():
+    if os.path.realpath(srclink) == srcfolder:
+        return
+
+    os.makedirs(os.path.dirname(srclink), exist_ok=True)
+    if os.path.lexists(f"{srclink}.new"):
+        os.remove(f"{srclink}.new")
+    os.symlink(srcfolder, f"{srclink}.new")
+    os.replace(f"{srclink}.new", srclink)
+
+
+def load_inventory(path):
+    hosts = []
+
+    with open(path, "r", newline="") as f:
+        if path.endswith(".json"):
+            hosts = json.load(f)
+        else:
+            for row in csv.DictReader(f):
+                hosts.append(row)
+
+    for host in hosts:
+        for key, val in host.items():
+            if isinstance(val, str):
+                host[key] = val.strip()
+        host["mac"] = host.get("mac", "").lower().replace("-", ":")
+
+    return hosts
 
 
 def valid_email(mail):
@@ -412,6 +957,16 @@ done = f"{cok}OK{c0}:"
 warning = f"{cw}W{c0}:"
 
 srcfolder = os.path.dirname(os.path.realpath(__file__))
+srclink = "/usr/local/lib/servers"
+
+dltimeout = 60
+dlchunk = 1024 * 1024
+dlsegmentmin = 64 * 1024 * 1024
+
+cachefolder = "/var/cache/servers"
+cachemax = 8 * 1024 * 1024 * 1024
+cachegrace = 3600
+cachelock = threading.Lock()
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
@@ -3,6 +3,8 @@
 import sys
 import re
 import os
+import shutil
+import ipaddress
 import _myhelpers_ as myh
 
 __description__ = "Install a DHCP server on Debian"
@@ -99,7 +101,86 @@ def set_pxe(subnet, srvip):
     return pxeip
 
 
-def configure_server(domain, subnet, dhcpstart, dhcpend, pxeip, iface):
+def set_inventories(domain, subnet):
+    definventories = []
+    for name in [domain, subnet]:
+        if os.path.isfile(f"{srcfolder}/conf/hosts/{name}.csv"):
+            definventories.append(f"{srcfolder}/conf/hosts/{name}.csv")
+
+    if definventories != []:
+        inventories = input(f"Host reservation inventories [default: "
+                            f"'{', '.join(definventories)}', 'none' to "
+                            f"skip] ? ")
+        if inventories == "":
+            inventories = ",".join(definventories)
+    else:
+        inventories = input("Host reservation inventories [default: none] ? ")
+
+    if inventories in ["", "none"]:
+        return [], []
+
+    inventorylist = [i.strip() for i in inventories.split(",") if i.strip()]
+    hosts = []
+    for inventory in inventorylist:
+        if not os.path.isfile(inventory):
+            print(f"{error} '{inventory}' does not exist")
+            return set_inventories(domain, subnet)
+        hosts += myh.load_inventory(inventory)
+
+    return inventorylist, hosts
+
+
+def check_reservations(hosts, subnet):
+    reservations = []
+    conflicts = []
+
+    network = ipaddress.ip_network(f"{subnet}.0/24")
+    bymac = {}
+    byip = {}
+    byname = {}
+    for host in hosts:
+        name = host.get("hostname", "")
+        mac = host.get("mac", "")
+        ipaddr = host.get("ip", "")
+
+        if not re.match('^[a-z0-9][a-z0-9_-]*$', name.lower()):
+            conflicts.append(f"invalid hostname '{name}'")
+            continue
+        if not re.match('^([0-9a-f]{2}:){5}[0-9a-f]{2}$', mac):
+            conflicts.append(f"'{name}': invalid MAC address '{mac}'")
+            continue
+        if mac in bymac:
+            conflicts.append(f"'{name}': MAC {mac} already used by "
+                             f"'{bymac[mac]}'")
+        bymac.setdefault(mac, name)
+        if ipaddr == "":
+            continue
+
+        try:
+            address = ipaddress.ip_address(ipaddr)
+        except ValueError:
+            conflicts.append(f"'{name}': invalid IP address '{ipaddr}'")
+            continue
+        ipaddr = str(address)
+
+        if address not in network or address in [network.network_address,
+                                                 network.broadcast_address]:
+            conflicts.append(f"'{name}': {ipaddr} is out of {network}")
+        if ipaddr in byip:
+            conflicts.append(f"'{name}': IP {ipaddr} already used by "
+                             f"'{byip[ipaddr]}'")
+        if name in byname:
+            conflicts.append(f"'{name}': hostname already reserved")
+        byip.setdefault(ipaddr, name)
+        byname.setdefault(name, mac)
+
+        reservations.append([name, mac, ipaddr])
+
+    return reservations, conflicts
+
+
+def configure_server(domain, subnet, dhcpstart, dhcpend, pxeip, iface,
+                     reservations):
     print(f"{ci}Configuring server...{c0}")
     myh.common_config()
 
@@ -108,43 +189,33 @@ def configure_server(domain, subnet, dhcpstart, dhcpend, pxeip, iface):
 
     dhcpconf = "/etc/dhcp/dhcpd.conf"
     if os.path.isfile(dhcpconf):
-        os.rename(dhcpconf, f"{dhcpconf}.o")
-
-    with open(dhcpconf, "w") as f:
-        f.write("default-lease-time 600;\n")
-        f.write("max-lease-time 7200;\n\n")
-        f.write("allow booting;\n\n")
-        f.write(f"subnet {subnet}.0"+" netmask 255.255.255.0 {\n")
-        f.write(f"    range {dhcpstart} {dhcpend};"+"\n")
-        f.write(f"    #option broadcast-address {subnet}.255;"+"\n")
-        f.write(f"    option routers {gateway};"+"\n")
-        f.write(f"    option domain-name-servers {dnssrv};"+"\n")
-        f.write(f'    option domain-name "{domain}"'+";\n")
-        f.write(f"    next-server {pxeip};"+"\n")
-        f.write("    filename \"pxelinux.0\";\n")
-        f.write("}\n\n")
-        f.write("group {\n")
-        f.write(f"    next-server {pxeip};"+"\n")
-        f.write("    host tftpclient {\n")
-        f.write("        filename \"pxelinux.0\";\n")
-        f.write("    }\n}\n")
-
-    if domain == "choopsit.lan":
-        serversdict = {"router": ["08:00:27:50:96:93", "192.168.10.254"],
-                       "pxe": ["08:00:27:83:e9:d5", "192.168.10.1"],
-                       "salt": ["08:00:27:9e:64:00", "192.168.10.2"]}
-        with open(dhcpconf, "a") as f:
-            for server, vals in serversdict.items():
-                f.write("\n")
-                f.write(f"host {server} {"+"\n")
-                f.write(f"    hardware ethernet {vals[0]};"+"\n")
-                f.write(f"    fixed-address {vals[1]};"+"\n}\n")
-    
-    if subnet == "192.168.42":
-        with open(dhcpconf, "a") as f:
-            f.write("\nhost mrchat {\n")
-            f.write("    hardware ethernet 6e:bc:7f:c4:34:0a;\n")
-            f.write("    fixed-address 192.168.42.200;\n}\n")
+        shutil.copy2(dhcpconf, f"{dhcpconf}.o")
+
+    conflines = ["default-lease-time 600;\n",
+                 "max-lease-time 7200;\n", "\n",
+                 "allow booting;\n", "\n",
+                 f"subnet {subnet}.0 netmask 255.255.255.0 {{\n",
+                 f"    range {dhcpstart} {dhcpend};\n",
+                 f"    #option broadcast-address {subnet}.255;\n",
+                 f"    option routers {gateway};\n",
+                 f"    option domain-name-servers {dnssrv};\n",
+                 f'    option domain-name "{domain}";\n',
+                 f"    next-server {pxeip};\n",
+                 '    filename "pxelinux.0";\n',
+                 "}\n", "\n",
+                 "group {\n",
+                 f"    next-server {pxeip};\n",
+                 "    host tftpclient {\n",
+                 '        filename "pxelinux.0";\n',
+                 "    }\n", "}\n"]
+
+    for name, mac, ipaddr in reservations:
+        conflines += ["\n",
+                      f"host {name} {{\n",
+                      f"    hardware ethernet {mac};\n",
+                      f"    fixed-address {ipaddr};\n", "}\n"]
+
+    myh.write_if_changed(dhcpconf, conflines)
 
     dhcpdef = "/etc/default/isc-dhcp-server"
     if os.path.isfile(dhcpdef):
@@ -178,8 +249,6 @@ srcfolder = os.path.dirname(os.path.realpath(__file__))
 olddebian = ["stretch", "jessie", "wheezy", "squeeze", "lenny"]
 debianstable = "buster"
 
-currentpath = os.getcwd()
-
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         if re.match('^-(h|-help)$', sys.argv[1]):
@@ -201,6 +270,14 @@ if __name__ == "__main__":
     mydhcpstart, mydhcpend = set_dhcp(mysubnet)
     mypxe = set_pxe(mysubnet, myip)
 
+    myinventories, myhosts = set_inventories(mydomain, mysubnet)
+    myreservations, myconflicts = check_reservations(myhosts, mysubnet)
+    if myconflicts != []:
+        for myconflict in myconflicts:
+            print(f"{error} {myconflict}")
+        print(f"{error} Fix host inventories before going on")
+        exit(1)
+
     print(f"\n{ci}Server settings{c0}:")
     print(f"  - {ci}Hostname{c0}:   {myhostname}")
     print(f"  - {ci}Domain{c0}:     {mydomain}")
@@ -209,6 +286,9 @@ if __name__ == "__main__":
     print(f"{ci}DHCP settings{c0}:")
     print(f"  - {ci}DHCP range{c0}: {mydhcpstart} - {mydhcpend}")
     print(f"  - {ci}PXE server{c0}: {mypxe}")
+    if myinventories != []:
+        print(f"  - {ci}Reservations{c0}: {len(myreservations)} hosts from "
+              f"{', '.join(myinventories)}")
 
     confconf = input("Confirm configuration [Y/n] ? ")
     if re.match('^(n|no)$', confconf):
@@ -222,4 +302,4 @@ if __name__ == "__main__":
     myh.install_server(mypkgs)
 
     configure_server(mydomain, mysubnet, mydhcpstart, mydhcpend, mypxe,
-                     myiface)
+                     myiface, myreservations)
@@ -163,6 +163,58 @@ def select_distros():
     return distlist
 
 
+def set_mirror():
+    if not re.match('^(y|yes)$', myh.yesno("Mirror the chosen distributions",
+                                           "y")):
+        return [False, "", "", ""]
+
+    archs = input("Architectures to mirror [default: 'amd64'] ? ")
+    if archs == "":
+        archs = "amd64"
+
+    components = input("Components to mirror [default: 'main'] ? ")
+    if components == "":
+        components = "main"
+
+    pkglist = input("Package list file [default: none, whole components] ? ")
+    if pkglist != "":
+        if not os.path.isfile(pkglist):
+            print(f"{error} '{pkglist}' does not exist")
+            return set_mirror()
+        pkglist = os.path.abspath(pkglist)
+        print(f"{warning} A filtered mirror is signed with the localrepo "
+              f"key, netboot\n   installers only trust the archive keys and "
+              f"cannot install from it")
+
+    return [True, archs, components, pkglist]
+
+
+def set_aptcache():
+    if not re.match('^(y|yes)$', myh.yesno("Caching apt proxy", "n")):
+        return [False, 0]
+
+    cachesize = input(f"Max proxy cache size in GiB [default: "
+                      f"{aptcachesize}] ? ")
+    if cachesize == "":
+        cachesize = aptcachesize
+    try:
+        cachesize = int(cachesize)
+    except ValueError:
+        print(f"{error} Invalid size '{cachesize}'")
+        return set_aptcache()
+
+    return [True, cachesize]
+
+
+def set_webserver():
+    if re.match('^(y|yes)$', myh.yesno("Serve repository with lightweight "
+                                       "built-in server instead of apache2",
+                                       "n")):
+        return "reposerve"
+
+    return "apache2"
+
+
 def generate_gpgkey(maintainer, maintainermail, gpgpass):
     tmpfolder = "/tmp"
     keyfolder = "/root/.gnupg"
@@ -194,7 +246,7 @@ def generate_gpgkey(maintainer, maintainermail, gpgpass):
     # TODO: run f"{tmpfolder}/entropy.sh" in parallel and stop it when done
 
     keyid_cmd = "gpg --list-keys | grep -P '^\ ' | grep -o '.\{8\}$'"
-    keyid = os.popen(keyid_cmd).read()
+    keyid = os.popen(keyid_cmd).read().strip()
 
     return keyid
 
@@ -213,11 +265,127 @@ def add_repobranches(repofolder, distlist, keyid):
             f.write("Architectures: i386 amd64 source\n")
             f.write("Components: main\n")
             f.write(f"Description: Local repository for {dist}\n")
-            f.write(f"SignWith: {keyid}\n")
+            f.write(f"SignWith: {keyid}\n\n")
+
+
+def write_repoconf(repofolder, keyid, gpgpass, distlist, mirror):
+    passfile = "/root/.gnupg/localrepo.pass"
+    passfd = os.open(passfile, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+    os.fchmod(passfd, 0o600)
+    with os.fdopen(passfd, "w") as f:
+        f.write(f"{gpgpass}\n")
+
+    with open(repoconfile, "w") as f:
+        f.write(f"srcfolder={srcfolder}\n")
+        f.write(f"repofolder={repofolder}\n")
+        f.write(f"keyid={keyid}\n")
+        f.write(f"gpgpassfile={passfile}\n")
+        f.write(f"distributions={','.join(distlist)}\n")
+        if mirror[0]:
+            f.write(f"mirrorfolder={mirrorfolder}\n")
+            f.write(f"mirror_archs={mirror[1]}\n")
+            f.write(f"mirror_components={mirror[2]}\n")
+            f.write(f"mirror_packages={mirror[3]}\n")
+
+
+def install_scripts():
+    scriptfolder = f"{srcfolder}/conf/localrepo/bin"
+    for script in os.listdir(scriptfolder):
+        target = f"/usr/local/bin/{script}"
+        if os.path.exists(target):
+            os.remove(target)
+        shutil.copy(f"{scriptfolder}/{script}", target)
+    myh.link_srcfolder()
+
+
+def configure_mirror():
+    print(f"{ci}Synchronizing mirrors...{c0}")
+    os.makedirs(mirrorfolder, exist_ok=True)
+
+    with open("/etc/cron.d/reposync", "w") as f:
+        f.write("# Nightly sync of localrepo partial mirrors\n")
+        f.write("30 3 * * * root /usr/local/bin/reposync >/dev/null\n")
+
+    os.system("/usr/local/bin/reposync")
+
+
+def configure_aptcache(ipaddr, cachesize):
+    print(f"{ci}Configuring caching apt proxy...{c0}")
+    unitfile = "/etc/systemd/system/aptcache.service"
+    with open(unitfile, "w") as f:
+        f.write("[Unit]\n")
+        f.write("Description=Caching HTTP proxy for APT clients\n")
+        f.write("After=network-online.target\n")
+        f.write("Wants=network-online.target\n\n")
+        f.write("[Service]\n")
+        f.write(f"ExecStart=/usr/local/bin/aptcache -a {ipaddr}")
+        f.write(f" -p {aptcacheport} -s {cachesize} /var/cache/aptcache\n")
+        f.write("Restart=on-failure\n")
+        f.write("DynamicUser=yes\n")
+        f.write("CacheDirectory=aptcache\n")
+        f.write("ProtectSystem=strict\n\n")
+        f.write("[Install]\n")
+        f.write("WantedBy=multi-user.target\n")
+
+    os.system("systemctl daemon-reload")
+    for srvcop in ["enable", "restart"]:
+        os.system(f"systemctl {srvcop} aptcache")
+
+    print(f"{done} Point clients to it with "
+          f"'Acquire::http::Proxy \"http://{ipaddr}:{aptcacheport}\";'")
+
+
+def configure_incoming(repofolder, distlist):
+    print(f"{ci}Configuring incoming packages watcher...{c0}")
+    for dist in distlist:
+        os.makedirs(f"{repofolder}/incoming/{dist.split()[1]}",
+                    exist_ok=True)
+
+    unitfile = "/etc/systemd/system/repoincoming.service"
+    with open(unitfile, "w") as f:
+        f.write("[Unit]\n")
+        f.write("Description=Import packages dropped in localrepo incoming\n")
+        f.write("After=local-fs.target\n\n")
+        f.write("[Service]\n")
+        f.write("ExecStart=/usr/local/bin/repoincoming\n")
+        f.write("Environment=HOME=/root\n")
+        f.write("Restart=on-failure\n\n")
+        f.write("[Install]\n")
+        f.write("WantedBy=multi-user.target\n")
+
+    os.system("systemctl daemon-reload")
+    for srvcop in ["enable", "restart"]:
+        os.system(f"systemctl {srvcop} repoincoming")
+
+    print(f"{done} Drop .deb files in '{repofolder}/incoming/<codename>'")
+
+
+def configure_reposerve(ipaddr):
+    print(f"{ci}Configuring built-in repository web server...{c0}")
+    unitfile = "/etc/systemd/system/reposerve.service"
+    with open(unitfile, "w") as f:
+        f.write("[Unit]\n")
+        f.write("Description=Lightweight static HTTP server for localrepo\n")
+        f.write("After=network-online.target\n")
+        f.write("Wants=network-online.target\n\n")
+        f.write("[Service]\n")
+        f.write(f"ExecStart=/usr/local/bin/reposerve -a {ipaddr} -p 80")
+        f.write(" /var/www/html\n")
+        f.write("Restart=on-failure\n")
+        f.write("DynamicUser=yes\n")
+        f.write("AmbientCapabilities=CAP_NET_BIND_SERVICE\n")
+        f.write("LimitNOFILE=65536\n")
+        f.write("ProtectSystem=strict\n\n")
+        f.write("[Install]\n")
+        f.write("WantedBy=multi-user.target\n")
+
+    os.system("systemctl daemon-reload")
+    for srvcop in ["enable", "restart"]:
+        os.system(f"systemctl {srvcop} reposerve")
 
 
 def configure_server(repofolder, maintainer, maintainermail, gpgpass,
-                     distlist):
+                     distlist, mirror, ipaddr, aptcache, webserver):
     print(f"{ci}Configuring local repository server...{c0}")
 
     myh.common_config()
@@ -225,7 +393,8 @@ def configure_server(repofolder, maintainer, maintainermail, gpgpass,
     if not os.path.isdir(repofolder):
         os.makedirs(repofolder)
 
-    os.system("systemctl restart apache2")
+    if webserver == "apache2":
+        os.system("systemctl restart apache2")
 
     for subfolder in ["conf", "incoming", "key"]:
         os.makedirs(f"{repofolder}/{subfolder}")
@@ -240,6 +409,17 @@ def configure_server(repofolder, maintainer, maintainermail, gpgpass,
 
     add_repobranches(repofolder, distlist, repokeyid)
 
+    write_repoconf(repofolder, repokeyid, gpgpass, distlist, mirror)
+    install_scripts()
+    os.system("/usr/local/bin/repoindex")
+    configure_incoming(repofolder, distlist)
+    if webserver == "reposerve":
+        configure_reposerve(ipaddr)
+    if mirror[0]:
+        configure_mirror()
+    if aptcache[0]:
+        configure_aptcache(ipaddr, aptcache[1])
+
 
 c0 = "\33[0m"
 ce = "\33[31m"
@@ -259,6 +439,11 @@ debiantesting = "bullseye"
 
 currentpath = os.getcwd()
 
+repoconfile = "/etc/localrepo.conf"
+mirrorfolder = "/var/www/html/mirror"
+aptcacheport = 3142
+aptcachesize = 32
+
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         if re.match('^-(h|-help)$', sys.argv[1]):
@@ -277,6 +462,11 @@ if __name__ == "__main__":
 
     myrepo, myfolder, mymaintainer, mymaintainermail, mygpgpass = set_repo()
     mydistlist = select_distros()
+    mymirror = [False]
+    if mydistlist != []:
+        mymirror = set_mirror()
+    myaptcache = set_aptcache()
+    mywebserver = set_webserver()
 
     print(f"\n{ci}Server settings{c0}:")
     print(f"  - {ci}Hostname{c0}:   {myhostname}")
@@ -290,6 +480,16 @@ if __name__ == "__main__":
     print(f"    - {ci}Email{c0}: {mymaintainermail}")
     print(f"  - {ci}GPG passphrase{c0}: {mygpgpass}")
     print(f"  - {ci}Distributions to supply{c0}: {mydistlist}")
+    if mymirror[0]:
+        print(f"  - {ci}Mirror{c0}: {mymirror[1]} {mymirror[2]} in "
+              f"{mirrorfolder}")
+        if mymirror[3] != "":
+            print(f"    - {ci}Packages from{c0}: {mymirror[3]}")
+    if myaptcache[0]:
+        print(f"  - {ci}Apt proxy{c0}: port {aptcacheport}, "
+              f"{myaptcache[1]} GiB cache")
+
+    print(f"  - {ci}Web server{c0}: {mywebserver}")
 
     confconf = input("Confirm configuration [Y/n] ? ")
     if re.match('^(n|no)$', confconf):
@@ -299,8 +499,14 @@ if __name__ == "__main__":
     if renewip:
         myh.fix_ip(myiface, myip, myoldip)
 
-    mypkgs = ["apache2", "reprepro"]
+    mypkgs = ["reprepro"]
+    if mywebserver == "apache2":
+        mypkgs.append("apache2")
+    if mymirror[0]:
+        mypkgs += ["gpgv", "debian-archive-keyring"]
+        if "ubuntu" in " ".join(mydistlist):
+            mypkgs.append("ubuntu-keyring")
     myh.install_server(mypkgs)
 
     configure_server(myfolder, mymaintainer, mymaintainermail, mygpgpass,
-                     mydistlist)
+                     mydistlist, mymirror, myip, myaptcache, mywebserver)
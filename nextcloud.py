@@ -3,7 +3,6 @@
 import sys
 import re
 import os
-import urllib.request
 import zipfile
 import _myhelpers_ as myh
 
@@ -86,11 +85,12 @@ def configure_server(hostname, domain):
     #   - MariaDB [(none)]> EXIT;
 
     dlurl = "https://download.nextcloud.com/server/releases/latest.zip"
-    dltgt = "/tmp/nextcloud.zip"
-    urllib.request.urlretrieve(dlurl, dltgt)
+    dltgt = myh.cached_download(dlurl, f"{dlurl}.sha256", segments=4)
+    if dltgt is None:
+        exit(1)
 
     nextcloudpath = "/var/www/html/nextcloud"
-    with zipfile.ZipFile(f"/tmp/{dltgt}", "r") as zipref:
+    with zipfile.ZipFile(dltgt, "r") as zipref:
         zipref.extractall(nextcloudpath)
     
     myh.recursive_chown(nextcloudpath, "www-data", "www-data")
@@ -4,10 +4,12 @@ import sys
 import re
 import os
 import shutil
-import urllib.request
 import tarfile
 import zipfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import _myhelpers_ as myh
+import _isoreader_ as isor
 
 __description__ = "Install a PXE Boot server on Debian"
 __author__ = "Choops <choopsbd@gmail.com>"
@@ -60,10 +62,159 @@ def set_pxetitle(domain):
     return pxetitle
 
 
-def ref_utils(ipaddr):
+def set_inventory(domain):
+    definventory = f"{srcfolder}/conf/hosts/{domain}.csv"
+    if os.path.isfile(definventory):
+        inventory = input(f"Host inventory [default: '{definventory}', "
+                          f"'none' to skip] ? ")
+        if inventory == "":
+            inventory = definventory
+    else:
+        inventory = input("Host inventory [default: none] ? ")
+
+    if inventory in ["", "none"]:
+        return "", []
+
+    if not os.path.isfile(inventory):
+        print(f"{error} '{inventory}' does not exist")
+        return set_inventory(domain)
+
+    return inventory, myh.load_inventory(inventory)
+
+
+def set_bootproto():
+    print(f"{ci}Available boot file transfers{c0}:")
+    print(f"  0) {ci}tftp{c0} (everything over TFTP)")
+    print(f"  1) {ci}http{c0} (only the loader over TFTP, then HTTP)")
+    protochoice = input("Your choice [default: 0] ? ")
+    if protochoice in ["", "0"]:
+        bootproto = "tftp"
+    elif protochoice == "1":
+        bootproto = "http"
+    else:
+        print(f"{error} Invalid choice '{protochoice}'")
+        bootproto = set_bootproto()
+
+    return bootproto
+
+
+def boot_prefix(ipaddr, bootproto):
+    if bootproto == "http":
+        return f"http://{ipaddr}/{httpalias}/"
+
+    return ""
+
+
+def clonezilla_entry(label, ipaddr, bootproto, ocsparams):
+    bootprefix = boot_prefix(ipaddr, bootproto)
+
+    czmenu = f"\nLABEL {label}\n"
+    czmenu += f"  KERNEL {bootprefix}clonezilla/live/vmlinuz\n"
+    czmenu += "  APPEND rootfstype=nfs netboot=nfs"
+    czmenu += f" nfsroot={ipaddr}:{tftproot}/clonezilla"
+    czmenu += f" nfsopts=rsize={nfsrwsize},wsize={nfsrwsize}"
+    czmenu += f" initrd={bootprefix}clonezilla/live/initrd.img"
+    czmenu += " boot=live union=overlay"
+    czmenu += " username=user config components quiet noswap"
+    czmenu += " edd=on nomodeset nodmraid locales= keyboard-layouts="
+    czmenu += ocsparams
+    czmenu += " ip= vga=788 net.ifnames=0 nosplash"
+    czmenu += " i915.blacklist=yes radeonhd.blacklist=yes"
+    czmenu += " nouveau.blacklist=yes vmwgfw.enable_fbdev=1\n"
+
+    return czmenu
+
+
+def set_multicast():
+    if not re.match('^(y|yes)$', myh.yesno("Clonezilla multicast restore",
+                                           "n")):
+        return [False]
+
+    image = input("Image to restore [default: 'ask_user'] ? ")
+    if image == "":
+        image = "ask_user"
+    elif not re.match('^[A-Za-z0-9._-]+$', image):
+        print(f"{error} Invalid image name '{image}'")
+        return set_multicast()
+
+    disk = input("Target disk on clients [default: 'sda'] ? ")
+    if disk == "":
+        disk = "sda"
+
+    mcastclients = input("Clients to wait for [default: 10] ? ")
+    mcastwait = input("Max seconds to wait for clients [default: 300] ? ")
+    try:
+        mcastclients = int(mcastclients or 10)
+        mcastwait = int(mcastwait or 300)
+    except ValueError:
+        print(f"{error} Invalid number")
+        return set_multicast()
+
+    return [True, image, disk, mcastclients, mcastwait]
+
+
+def partimag_mount(ipaddr):
+    mountcmd = f"mount -t nfs -o rsize={nfsrwsize},wsize={nfsrwsize}"
+    mountcmd += f" {ipaddr}:{partimagfolder} {partimagfolder}"
+
+    return mountcmd
+
+
+def set_nfsclients(default):
+    nfsclients = input("Expected simultaneous Clonezilla clients "
+                       f"[default: {default}] ? ")
+    if nfsclients == "":
+        return default
+
+    try:
+        return int(nfsclients)
+    except ValueError:
+        print(f"{error} Invalid number '{nfsclients}'")
+        return set_nfsclients(default)
+
+
+def choose_czprofiles():
+    print(f"{ci}Available Clonezilla image profiles{c0}:")
+    i = 0
+    for key, val in czprofiles.items():
+        print(f"  {i}) {ci}{key}{c0} ({val[0]})")
+        i += 1
+
+    return choose_me(list(czprofiles))
+
+
+def czprofile_entry(ipaddr, bootproto, profile):
+    ocscmd = f"ocs-sr -q2 -c -j2 {czprofiles[profile][1]} -i 4096"
+    ocscmd += " -sfsck -senc -p choose savedisk ask_user ask_user"
+
+    ocsparams = f" ocs_prerun=\"{partimag_mount(ipaddr)}\""
+    ocsparams += f" ocs_live_run=\"{ocscmd}\""
+    ocsparams += " ocs_live_extra_param=\"\" ocs_live_batch=no"
+
+    return clonezilla_entry(f"Clonezilla save {profile}", ipaddr, bootproto,
+                            ocsparams)
+
+
+def multicast_entry(ipaddr, bootproto, multicast):
+    ocscmd = "ocs-sr -e1 auto -e2 -r -j2 -batch -p reboot"
+    ocscmd += f" --mcast-port {mcastport}"
+    ocscmd += f" multicast_restoredisk {multicast[1]} {multicast[2]}"
+
+    ocsparams = f" ocs_prerun=\"{partimag_mount(ipaddr)}\""
+    ocsparams += f" ocs_live_run=\"{ocscmd}\""
+    ocsparams += " ocs_live_extra_param=\"\" ocs_live_batch=yes"
+
+    return clonezilla_entry("Clonezilla multicast restore", ipaddr,
+                            bootproto, ocsparams)
+
+
+def ref_utils(ipaddr, bootproto):
+    bootprefix = boot_prefix(ipaddr, bootproto)
+
     ufiles = []
     uurls = []
     umenus = []
+    usums = []
 
     ufiles.append("clonezilla.iso")
     # czurl = "https://osdn.net/dl/clonezilla/"
@@ -72,17 +223,12 @@ def ref_utils(ipaddr):
     czurl += f"clonezilla_live_stable/{clonezillalatest}/"
     czurl += f"clonezilla-live-{clonezillalatest}-amd64.iso"
     uurls.append(czurl)
-    czmenu = "\nLABEL Clonezilla\n"
-    czmenu += "  KERNEL clonezilla/live/vmlinuz\n"
-    czmenu += "  APPEND rootfstype=nfs netboot=nfs"
-    czmenu += f" nfsroot={ipaddr}:{tftproot}/clonezilla"
-    czmenu += " initrd=clonezilla/live/initrd.img boot=live union=overlay"
-    czmenu += " username=user config components quiet noswap"
-    czmenu += " edd=on nomodeset nodmraid locales= keyboard-layouts="
-    czmenu += " ocs_live_run=\"ocs-live-general\" ocs_live_extra_param=\"\""
-    czmenu += " ocs_live_batch=no ip= vga=788 net.ifnames=0 nosplash"
-    czmenu += " i915.blacklist=yes radeonhd.blacklist=yes"
-    czmenu += " nouveau.blacklist=yes vmwgfw.enable_fbdev=1\n"
+    czsum = "https://sourceforge.net/projects/clonezilla/files/"
+    czsum += f"clonezilla_live_stable/{clonezillalatest}/CHECKSUMS.TXT"
+    usums.append([czsum, None])
+    czmenu = clonezilla_entry("Clonezilla", ipaddr, bootproto,
+                              " ocs_live_run=\"ocs-live-general\""
+                              " ocs_live_extra_param=\"\" ocs_live_batch=no")
     umenus.append(czmenu)
 
     ufiles.append("gparted.zip")
@@ -90,58 +236,122 @@ def ref_utils(ipaddr):
     gpurl += f"gparted-live-stable/{gpartedlatest}/"
     gpurl += f"gparted-live-{gpartedlatest}-amd64.zip"
     uurls.append(gpurl)
+    gpsum = "https://sourceforge.net/projects/gparted/files/"
+    gpsum += f"gparted-live-stable/{gpartedlatest}/CHECKSUMS.TXT"
+    usums.append([gpsum, None])
     gpmenu = "\nLABEL Gparted\n"
-    gpmenu += "  KERNEL gparted/vmlinuz\n"
-    gpmenu += "  APPEND initrd=gparted/initrd.img boot=live"
+    gpmenu += f"  KERNEL {bootprefix}gparted/vmlinuz\n"
+    gpmenu += f"  APPEND initrd={bootprefix}gparted/initrd.img boot=live"
     gpmenu += " config union=overlay username=user noswap noprompt vga=788"
-    gpmenu += f" fetch=tftp://{ipaddr}/gparted/filesystem.squashfs\n"
+    if bootproto == "http":
+        gpmenu += f" fetch={bootprefix}gparted/filesystem.squashfs\n"
+    else:
+        gpmenu += f" fetch=tftp://{ipaddr}/gparted/filesystem.squashfs\n"
     umenus.append(gpmenu)
 
     ufiles.append("memtest.zip")
     mturl = f"http://www.memtest.org/download/{memtestlatest}/"
     mturl += f"memtest86+-{memtestlatest}.bin.zip"
     uurls.append(mturl)
-    mtmenu = "\nLABEL Memtest86+\n  KERNEL memtest\n"
+    usums.append([None, None])
+    mtmenu = f"\nLABEL Memtest86+\n  KERNEL {bootprefix}memtest\n"
     umenus.append(mtmenu)
 
     dictutilsref = {}
     for i in range(len(utilities)):
         dictutilsref[utilities[i]] = [ufiles[i], uurls[i], umenus[i]]
+        dictutilsref[utilities[i]] += usums[i]
 
     return dictutilsref
 
 
-def ref_netboots():
+def set_autoinstall():
+    if not re.match('^(y|yes)$', myh.yesno("Unattended installs", "n")):
+        return [False, "", ""]
+
+    mirrorhost = input("Local package mirror host [default: none] ? ")
+    if mirrorhost != "" and not myh.is_valid_hostname(mirrorhost):
+        print(f"{error} Invalid hostname '{mirrorhost}'")
+        return set_autoinstall()
+
+    rootpass = input("Root password for installed hosts ? ")
+    if rootpass == "":
+        print(f"{error} Root password can not be empty")
+        return set_autoinstall()
+
+    hashcmd = ["openssl", "passwd", "-6", "-stdin"]
+    hashproc = subprocess.run(hashcmd, input=rootpass, capture_output=True,
+                              text=True)
+    if hashproc.returncode != 0:
+        print(f"{error} Failed to hash root password")
+        return set_autoinstall()
+
+    return [True, mirrorhost, hashproc.stdout.strip()]
+
+
+def preseed_entry(label, kernelpath, append, preseedurl):
+    entry = f"\nLABEL {label} unattended\n"
+    entry += f"  KERNEL {kernelpath}/linux\n"
+    entry += f"  APPEND initrd={kernelpath}/initrd.gz vga=788"
+    entry += f" auto=true priority=critical url={preseedurl} {append}\n"
+
+    return entry
+
+
+def ref_netboots(ipaddr, bootproto, autoinstall=False):
+    bootprefix = boot_prefix(ipaddr, bootproto)
+    preseedprefix = bootprefix
+    if bootproto == "tftp":
+        preseedprefix = f"tftp://{ipaddr}/"
+
     nfiles = []
     nurls = []
     nmenus = []
+    nsums = []
 
     for nb in netboots:
         nfiles.append(f"{nb.split()[0]}_netboot.tar.gz")
 
-    deburl = "http://ftp.nl.debian.org/debian/dists/stable/main/"
+    deburl = f"http://ftp.nl.debian.org/debian/dists/{debianstable}/main/"
     deburl += "installer-amd64/current/images/netboot/netboot.tar.gz"
     nurls.append(deburl)
+    debsum = f"http://ftp.nl.debian.org/debian/dists/{debianstable}/main/"
+    debsum += "installer-amd64/current/images/SHA256SUMS"
+    nsums.append([debsum, "netboot/netboot.tar.gz"])
     debmenu = "\nLABEL Debian stable\n"
-    debmenu += "  KERNEL debianstable/debian-installer/amd64/linux\n"
-    debmenu += "  APPEND initrd=debianstable/debian-installer/amd64/initrd.gz"
+    debpath = f"{bootprefix}debianstable/debian-installer/amd64"
+    debmenu += f"  KERNEL {debpath}/linux\n"
+    debmenu += f"  APPEND initrd={debpath}/initrd.gz"
     debmenu += " vga=788"
     debmenu += " ramdisk_size=9372 root=/dev/rd/0 devfs=mount,dall rw --\n"
+    if autoinstall:
+        debmenu += preseed_entry("Debian stable", debpath, "--",
+                                 f"{preseedprefix}preseed/debianstable.cfg")
     nmenus.append(debmenu)
 
     uburl = f"http://archive.ubuntu.com/ubuntu/dists/{ubuntults}-updates/main/"
     uburl += "installer-amd64/current/legacy-images/netboot/netboot.tar.gz"
     nurls.append(uburl)
+    ubsum = f"http://archive.ubuntu.com/ubuntu/dists/{ubuntults}-updates/"
+    ubsum += "main/installer-amd64/current/legacy-images/SHA256SUMS"
+    nsums.append([ubsum, "netboot/netboot.tar.gz"])
     ubmenu = "\nLABEL Ubuntu LTS\n"
-    ubmenu += "  KERNEL ubuntults/ubuntu-installer/amd64/linux\n"
-    ubmenu += "  APPEND initrd=ubuntults/ubuntu-installer/amd64/initrd.gz"
+    ubpath = f"{bootprefix}ubuntults/ubuntu-installer/amd64"
+    ubmenu += f"  KERNEL {ubpath}/linux\n"
+    ubmenu += f"  APPEND initrd={ubpath}/initrd.gz"
     ubmenu += " vga=788"
     ubmenu += " locale=fr_FR.UTF-8;keyboard-configuration/layoutcode=fr\n"
+    if autoinstall:
+        ubmenu += preseed_entry("Ubuntu LTS", ubpath,
+                                "locale=fr_FR.UTF-8 "
+                                "keyboard-configuration/layoutcode=fr",
+                                f"{preseedprefix}preseed/ubuntults.cfg")
     nmenus.append(ubmenu)
 
     dictnetbootsref = {}
     for i in range(len(netboots)):
         dictnetbootsref[netboots[i]] = [nfiles[i], nurls[i], nmenus[i]]
+        dictnetbootsref[netboots[i]] += nsums[i]
 
     return dictnetbootsref
 
@@ -159,13 +369,13 @@ def choose_me(choicesref):
         for choice in nchoicelist:
             try:
                 intchoice = int(choice)
-                chosenones.append(choicesref[intchoice])
             except ValueError:
                 print(f"{error} Invalid choice '{choice}'")
-                chosenones = choose_me(choicesref)
-            if intchoice not in range(choicesref):
+                return choose_me(choicesref)
+            if intchoice not in range(len(choicesref)):
                 print(f"{error} Out of range choice '{choice}'")
-                chosenones = choose_me(choicesref)
+                return choose_me(choicesref)
+            chosenones.append(choicesref[intchoice])
 
     return chosenones
 
@@ -211,98 +421,182 @@ def add_menu_to_default(menutitle, defaultf):
         f.write(f"APPEND pxelinux.cfg/{menutitle.lower()}\n")
 
 
-def download_netboot(distro, dlfile, url):
-    print(f"  - {ci}Downloading {distro}...{c0}")
-    urllib.request.urlretrieve(url, f"/tmp/{dlfile}")
+def download_file(item, url, sumurl, sumname):
+    print(f"  - {ci}Downloading {item}...{c0}")
+    dlpath = myh.cached_download(url, sumurl, sumname, dlsegments)
+    if dlpath is None:
+        print(f"{error} Failed to download {item}")
+        return None
+
+    print(f"  - {ci}{item} downloaded{c0}")
 
-    print(f"  - {ci}Adding {distro} to {tftproot}...{c0}")
+    return dlpath
+
+
+def fetch_netboot(distro, url, sumurl, sumname):
+    print(f"  - {ci}Fetching {distro} into {tftproot}...{c0}")
     nbpath = f"{tftproot}/{distro.lower().replace(' ', '')}"
-    if os.path.isdir(nbpath):
-        shutil.deltree(nbpath)
-    os.makedirs(nbpath)
+    stagingpath = f"{nbpath}.new"
+    if os.path.isdir(stagingpath):
+        shutil.rmtree(stagingpath)
+
+    deployed = None
+    if os.path.isfile(f"{nbpath}/{nbdigestfile}"):
+        with open(f"{nbpath}/{nbdigestfile}", "r") as f:
+            deployed = f.read().strip()
+
+    def extract(stream, sha256):
+        if sha256 == deployed:
+            return
+        os.makedirs(stagingpath)
+        with tarfile.open(fileobj=stream, mode="r|gz") as tar:
+            tar.extractall(stagingpath, filter="data")
+        with open(f"{stagingpath}/{nbdigestfile}", "w") as f:
+            f.write(f"{sha256}\n")
+
+    try:
+        streamed = myh.cached_stream(url, extract, sumurl, sumname)
+    except (tarfile.TarError, EOFError) as err:
+        print(f"{error} Invalid archive for {distro}: {err}")
+        streamed = False
+
+    if not streamed:
+        if os.path.isdir(stagingpath):
+            shutil.rmtree(stagingpath)
+        return None
+
+    if not os.path.isdir(stagingpath):
+        print(f"  - {ci}{distro} already up to date in {tftproot}{c0}")
+        return nbpath
 
-    os.chdir(nbpath)
-    tar = tarfile.open(f"/tmp/{dlfile}", "r:gz")
-    tar.extractall()
-    tar.close()
-    os.chdir(currentpath)
+    myh.atomic_swap(stagingpath, nbpath)
 
+    print(f"  - {ci}{distro} added to {tftproot}{c0}")
 
-def deploy_netboots(netboots, menufile):
-    for key, val in netboots.items():
-        download_netboot(key, val[0], val[1])
-        with open(menufile, "a") as f:
+    return nbpath
+
+
+def start_downloads(pool, items, job):
+    downloads = {}
+    for key, val in items.items():
+        downloads[pool.submit(job, key, val[1], val[3], val[4])] = key
+
+    return downloads
+
+
+def deploy_netboots(netboots, downloads, menufile):
+    failed = []
+    for future in as_completed(downloads):
+        if future.result() is None:
+            print(f"{error} Failed to add {downloads[future]}")
+            failed.append(downloads[future])
+
+    for key in failed:
+        del netboots[key]
+
+    with open(menufile, "a") as f:
+        for _, val in netboots.items():
             f.write(val[2])
 
+    return failed
+
 
-def download_util(util, dlfile, url):
-    print(f"  - {ci}Downloading {util}...{c0}")
-    urllib.request.urlretrieve(url, f"/tmp/{dlfile}")
+def extract_zip_members(archive, members):
+    try:
+        with zipfile.ZipFile(archive, "r") as zipref:
+            for member, tgt in members.items():
+                with zipref.open(member) as src, open(tgt, "wb") as dst:
+                    shutil.copyfileobj(src, dst, zipchunk)
+    except (OSError, KeyError, zipfile.BadZipFile) as err:
+        print(f"{error} Failed to extract from {archive}: {err}")
+        return False
 
+    return True
+
+
+def add_util(util, archive):
     print(f"  - {ci}Adding {util} to {tftproot}...{c0}")
     if util == "clonezilla":
         upath = f"{tftproot}/clonezilla"
-        partimagfolder = "/home/partimag"
 
         if not os.path.exists(partimagfolder):
             os.makedirs(partimagfolder)
         os.chmod(partimagfolder, 0o777)
 
-        mnt_cmd = f"mount -o loop -t iso9660 /tmp/{dlfile} /mnt"
-        if os.system(mnt_cmd) == 0:
-            if os.path.isdir(upath):
-                shutil.deltree(upath)
-            shutil.copytree("/mnt", upath, symlinks=True)
-            umnt_cmd = "umount /mnt"
-            os.system(umnt_cmd)
-        else:
-            print(f"{error} Failed to mount {dlfile} on /mnt")
-
-        nfsopt = "rw,async,no_wdelay,root_squash,insecure_locks,"
-        nfsopt += "no_subtree_check"
-        nfsconf = "/etc/exports"
-        nfsshares = [f"{tftproot}/clonezilla", f"{partimagfolder}"]
-        for share in nfsshares:
-            with open(nfsconf, "a+") as f:
-                if share not in f.read():
-                    f.write(f"{share} *({nfsopt})\n")
-        os.system("systemctl restart nfs-kernel-server")
+        stagingpath = f"{upath}.new"
+        if os.path.isdir(stagingpath):
+            shutil.rmtree(stagingpath)
+        czmembers = ["live/vmlinuz", "live/initrd.img",
+                     "live/filesystem.squashfs"]
+        try:
+            czfiles = isor.extract(archive, czmembers, stagingpath)
+        except (OSError, ValueError) as err:
+            print(f"{error} Failed to read {archive}: {err}")
+            czfiles = []
+
+        if len(czfiles) != len(czmembers):
+            print(f"{error} Failed to extract Clonezilla from {archive}")
+            if os.path.isdir(stagingpath):
+                shutil.rmtree(stagingpath)
+            return False
+
+        if os.path.isdir(upath):
+            shutil.rmtree(upath)
+        os.rename(stagingpath, upath)
 
     elif util == "gparted":
         upath = f"{tftproot}/gparted"
-        tmppath = "/tmp/gparted"
+        stagingpath = f"{upath}.new"
 
-        if os.path.isdir(tmppath):
-            shutil.deltree(tmppath)
-        os.makedirs(tmppath)
+        if os.path.isdir(stagingpath):
+            shutil.rmtree(stagingpath)
+        os.makedirs(stagingpath)
 
-        with zipfile.ZipFile(f"/tmp/{dlfile}", "r") as zipref:
-            zipref.extractall(tmppath)
+        gpmembers = {}
+        for gpfile in ["initrd.img", "vmlinuz", "filesystem.squashfs"]:
+            gpmembers[f"live/{gpfile}"] = f"{stagingpath}/{gpfile}"
+
+        if not extract_zip_members(archive, gpmembers):
+            shutil.rmtree(stagingpath)
+            return False
 
         if os.path.isdir(upath):
-            shutil.deltree(upath)
-        os.makedirs(upath)
-        for gpfile in ["initrd.img", "vmlinuz", "filesystem.squashfs"]:
-            shutil.copy(f"{tmppath}/live/{gpfile}", f"{upath}/{gpfile}")
+            shutil.rmtree(upath)
+        os.rename(stagingpath, upath)
 
     elif util == "memtest86+":
         upath = f"{tftproot}/memtest"
 
-        with zipfile.ZipFile(f"/tmp/{dlfile}", "r") as zipref:
-            zipref.extractall("/tmp")
+        mtmember = f"memtest86+-{memtestlatest}.bin"
+        if not extract_zip_members(archive, {mtmember: f"{upath}.new"}):
+            return False
+
+        os.chmod(f"{upath}.new", 0o755)
+        os.replace(f"{upath}.new", upath)
+
+    return True
 
-        shutil.copy(f"/tmp/memtest86+-{memtestlatest}.bin", upath)
-        os.chmod(upath, 0o755)
 
+def deploy_utils(utils, downloads, menufile):
+    failed = []
+    for future in as_completed(downloads):
+        key = downloads[future]
+        archive = future.result()
+        if archive is None or not add_util(key, archive):
+            print(f"{error} Failed to add {key}")
+            failed.append(key)
 
-def deploy_utils(utils, menufile):
-    for key, val in utils.items():
-        download_util(key, val[0], val[1])
-        with open(menufile, "a") as f:
+    for key in failed:
+        del utils[key]
+
+    with open(menufile, "a") as f:
+        for _, val in utils.items():
             f.write(val[2])
 
+    return failed
+
 
-def generate_menu(menutitle, pxebg, pxetitle, netboots, utils):
+def generate_menu(menutitle, pxebg, pxetitle, netboots, utils, downloads):
     print(f"{ci}Generating '{menutitle.capitalize()}' menu...{c0}")
     menufile = f"{tftproot}/pxelinux.cfg/{menutitle}"
     if not os.path.isfile(menufile):
@@ -320,35 +614,245 @@ def generate_menu(menutitle, pxebg, pxetitle, netboots, utils):
             f.write("MENU SEPARATOR\n")
 
     if menutitle == "install":
-        deploy_netboots(netboots, menufile)
-    elif menutitle == "utilities":
-        deploy_utils(utils, menufile)
+        failed = deploy_netboots(netboots, downloads["install"], menufile)
+    else:
+        failed = deploy_utils(utils, downloads["utilities"], menufile)
+
+    if failed != []:
+        print(f"{warning} Not in '{menutitle.capitalize()}' menu: "
+              f"{', '.join(failed)}")
+
+
+def host_entry(pxeboot, netboots, utils):
+    if pxeboot == "local":
+        return "\nLABEL auto\n  LOCALBOOT 0\n"
+
+    for items in [netboots, utils]:
+        for _, val in items.items():
+            for entry in val[2].strip("\n").split("\nLABEL "):
+                menulines = entry.split("\n")
+                if menulines[0].replace("LABEL ", "").lower() == pxeboot:
+                    return "\nLABEL auto\n" + "\n".join(menulines[1:]) + "\n"
+
+    return None
+
+
+def generate_hostconfigs(inventory, netboots, utils):
+    print(f"{ci}Generating per-host boot configurations...{c0}")
+    cfgfolder = f"{tftproot}/pxelinux.cfg"
+
+    hostconfigs = {}
+    for host in inventory:
+        pxeboot = host.get("pxeboot", "").lower()
+        if pxeboot == "":
+            continue
+
+        entry = host_entry(pxeboot, netboots, utils)
+        if entry is None:
+            print(f"{warning} Unknown boot '{pxeboot}' for "
+                  f"'{host['hostname']}'")
+            continue
+
+        if not re.match('^([0-9a-f]{2}:){5}[0-9a-f]{2}$', host["mac"]):
+            print(f"{warning} Invalid MAC '{host['mac']}' for "
+                  f"'{host['hostname']}', skipped")
+            continue
+
+        macfile = f"01-{host['mac'].replace(':', '-')}"
+        hostconfigs[macfile] = f"{hostcfgmarker}\n# {host['hostname']}\n"
+        hostconfigs[macfile] += f"DEFAULT auto\nPROMPT 0\nTIMEOUT 1\n{entry}"
+
+    for cfgfile in os.listdir(cfgfolder):
+        if not cfgfile.startswith("01-") or cfgfile in hostconfigs:
+            continue
+        with open(f"{cfgfolder}/{cfgfile}", "r", errors="replace") as f:
+            generated = f.readline().rstrip("\n") == hostcfgmarker
+        if generated:
+            os.remove(f"{cfgfolder}/{cfgfile}")
+
+    for macfile, config in hostconfigs.items():
+        with open(f"{cfgfolder}/{macfile}.new", "w") as f:
+            f.write(config)
+        os.replace(f"{cfgfolder}/{macfile}.new", f"{cfgfolder}/{macfile}")
+
+    print(f"  - {ci}{len(hostconfigs)} known hosts will boot directly{c0}")
+
+
+def generate_preseeds(netboots, domain, autoinstall):
+    print(f"{ci}Generating preseed files...{c0}")
+    preseedfolder = f"{tftproot}/preseed"
+    if not os.path.isdir(preseedfolder):
+        os.makedirs(preseedfolder)
+
+    mirrorhost = autoinstall[1]
+    for key, _ in netboots.items():
+        distro = key.split()[0].lower()
+        nbfolder = key.lower().replace(" ", "")
+        codename = ubuntults if distro == "ubuntu" else debianstable
+        if mirrorhost != "":
+            mirror = [mirrorhost, f"/mirror/{distro}"]
+        elif distro == "ubuntu":
+            mirror = ["archive.ubuntu.com", "/ubuntu"]
+        else:
+            mirror = ["deb.debian.org", "/debian"]
+
+        with open(f"{preseedfolder}/{nbfolder}.cfg", "w") as f:
+            f.write("d-i debian-installer/locale string fr_FR.UTF-8\n")
+            f.write("d-i keyboard-configuration/xkb-keymap select fr\n")
+            f.write("d-i netcfg/choose_interface select auto\n")
+            f.write("d-i netcfg/get_hostname string unassigned-hostname\n")
+            f.write(f"d-i netcfg/get_domain string {domain}\n")
+            f.write("d-i mirror/country string manual\n")
+            f.write(f"d-i mirror/http/hostname string {mirror[0]}\n")
+            f.write(f"d-i mirror/http/directory string {mirror[1]}\n")
+            f.write("d-i mirror/http/proxy string\n")
+            f.write(f"d-i mirror/suite string {codename}\n")
+            f.write(f"d-i mirror/codename string {codename}\n")
+            f.write("d-i passwd/root-login boolean true\n")
+            f.write("d-i passwd/make-user boolean false\n")
+            f.write("d-i passwd/root-password-crypted password")
+            f.write(f" {autoinstall[2]}\n")
+            f.write("d-i clock-setup/utc boolean true\n")
+            f.write("d-i time/zone string Europe/Paris\n")
+            f.write("d-i partman-auto/method string regular\n")
+            f.write("d-i partman-auto/choose_recipe select atomic\n")
+            f.write("d-i partman-partitioning/confirm_write_new_label"
+                    " boolean true\n")
+            f.write("d-i partman/choose_partition select finish\n")
+            f.write("d-i partman/confirm boolean true\n")
+            f.write("d-i partman/confirm_nooverwrite boolean true\n")
+            f.write("tasksel tasksel/first multiselect standard,"
+                    " ssh-server\n")
+            f.write("d-i pkgsel/include string vim ssh\n")
+            f.write("popularity-contest popularity-contest/participate"
+                    " boolean false\n")
+            f.write("d-i grub-installer/only_debian boolean true\n")
+            f.write("d-i grub-installer/bootdev string default\n")
+            f.write("d-i finish-install/reboot_in_progress note\n")
+
+    os.chmod(preseedfolder, 0o755)
+    for preseed in os.listdir(preseedfolder):
+        os.chmod(f"{preseedfolder}/{preseed}", 0o644)
+
+
+def dedupe_tftproot():
+    print(f"{ci}Hardlinking identical files in {tftproot}...{c0}")
+    saved = myh.hardlink_dedupe(tftproot, dedupeindex)
+    print(f"{done} {saved // 1024 // 1024} MiB reclaimed in {tftproot}")
+
+
+def configure_nfs(nfsclients):
+    print(f"{ci}Configuring NFS exports...{c0}")
+    nfsopt = "rw,async,no_wdelay,root_squash,insecure_locks,"
+    nfsopt += "no_subtree_check"
+    nfsexports = {}
+    for share in [f"{tftproot}/clonezilla", partimagfolder]:
+        nfsexports[share] = f"*({nfsopt})"
+    exportschanged = myh.update_exports(nfsexports)
+
+    cpus = os.cpu_count() or 1
+    nfsthreads = max(nfsminthreads, nfsclients * 2, cpus * 4)
+    nfsthreads = min(nfsthreads, nfsmaxthreads)
+    nfsdefault = "/etc/default/nfs-kernel-server"
+    threadschanged = myh.set_conf_value(nfsdefault, "RPCNFSDCOUNT",
+                                        nfsthreads)
+
+    if threadschanged:
+        os.system("systemctl restart nfs-kernel-server")
+    elif exportschanged:
+        os.system("exportfs -ra")
+    print(f"{done} {nfsthreads} nfsd threads for {nfsclients} clients")
+
+
+def set_tftpserver():
+    print(f"{ci}Available TFTP servers{c0}:")
+    print(f"  0) {ci}tftpd-hpa{c0}")
+    print(f"  1) {ci}pxetftpd{c0} (built-in, blksize/windowsize, cached)")
+    srvchoice = input("Your choice [default: 0] ? ")
+    if srvchoice in ["", "0"]:
+        tftpserver = "tftpd-hpa"
+    elif srvchoice == "1":
+        tftpserver = "pxetftpd"
+    else:
+        print(f"{error} Invalid choice '{srvchoice}'")
+        tftpserver = set_tftpserver()
+
+    return tftpserver
+
+
+def configure_tftp(ipaddr, tftpserver):
+    tftpunits = {"tftpd-hpa": "/lib/systemd/system/tftpd-hpa.service",
+                 "pxetftpd": "/etc/systemd/system/pxetftpd.service"}
+    for unit, unitfile in tftpunits.items():
+        if unit != tftpserver and os.path.isfile(unitfile):
+            os.system(f"systemctl disable --now {unit}")
+
+    if tftpserver == "pxetftpd":
+        unitfile = "/etc/systemd/system/pxetftpd.service"
+        with open(unitfile, "w") as f:
+            f.write("[Unit]\n")
+            f.write("Description=PXE TFTP server\n")
+            f.write("After=network-online.target\n")
+            f.write("Wants=network-online.target\n\n")
+            f.write("[Service]\n")
+            f.write(f"ExecStart=/usr/local/bin/pxetftpd -a {ipaddr}")
+            f.write(f" {tftproot}\n")
+            f.write("Restart=on-failure\n")
+            f.write("DynamicUser=yes\n")
+            f.write("AmbientCapabilities=CAP_NET_BIND_SERVICE\n")
+            f.write("ProtectSystem=strict\n\n")
+            f.write("[Install]\n")
+            f.write("WantedBy=multi-user.target\n")
+
+        os.system("systemctl daemon-reload")
+    else:
+        tftpconf = "/etc/default/tftpd-hpa"
+        with open(tftpconf, "w") as f:
+            f.write(f"TFTP_USERNAME=\"tftp\"\n")
+            f.write(f"TFTP_DIRECTORY=\"{tftproot}\"\n")
+            f.write(f"TFTP_ADDRESS=\"{ipaddr}:69\"\n")
+            f.write(f"TFTP_OPTIONS=\"--secure\"\n")
 
+    for srvcop in ["enable", "restart"]:
+        os.system(f"systemctl {srvcop} {tftpserver}")
 
-def configure_server(iface, ipaddr, domain, pxetitle, utils, netboots):
+
+def configure_httpboot():
+    httpconf = f"/etc/apache2/conf-available/{httpalias}.conf"
+    with open(httpconf, "w") as f:
+        f.write(f"Alias /{httpalias} {tftproot}\n\n")
+        f.write(f"<Directory {tftproot}>\n")
+        f.write("    Options +FollowSymLinks\n")
+        f.write("    EnableSendfile On\n")
+        f.write("    Require all granted\n")
+        f.write("</Directory>\n")
+
+    os.system(f"a2enconf {httpalias}")
+    for srvcop in ["enable", "restart"]:
+        os.system(f"systemctl {srvcop} apache2")
+
+
+def configure_server(iface, ipaddr, domain, pxetitle, utils, netboots,
+                     bootproto, tftpserver, inventory, autoinstall,
+                     multicast, nfsclients):
     print(f"{ci}Configuring PXE server...{c0}")
     myh.common_config()
 
     if not os.path.isdir(tftproot):
         os.makedirs(tftproot)
 
-    tftpconf = "/etc/default/tftpd-hpa"
-    with open(tftpconf, "w") as f:
-        f.write(f"TFTP_USERNAME=\"tftp\"\n")
-        f.write(f"TFTP_DIRECTORY=\"{tftproot}\"\n")
-        f.write(f"TFTP_ADDRESS=\"{ipaddr}:69\"\n")
-        f.write(f"TFTP_OPTIONS=\"--secure\"\n")
-
-    for srvcop in ["enable", "restart"]:
-        os.system(f"systemctl {srvcop} tftpd-hpa")
-
     for biosfile in ["chain.c32", "mboot.c32", "menu.c32", "reboot.c32",
                      "vesamenu.c32", "libcom32.c32", "libutil.c32",
                      "ldlinux.c32", "poweroff.c32"]:
         biossrc = "/usr/lib/syslinux/modules/bios"
-        shutil.copy(f"{biossrc}/{biosfile}", f"{tftproot}/{biosfile}")
+        myh.overwrite(f"{biossrc}/{biosfile}", f"{tftproot}/{biosfile}")
 
-    shutil.copy("/usr/lib/PXELINUX/pxelinux.0", f"{tftproot}/pxelinux.0")
+    if bootproto == "http":
+        pxeloader = "/usr/lib/PXELINUX/lpxelinux.0"
+        configure_httpboot()
+    else:
+        pxeloader = "/usr/lib/PXELINUX/pxelinux.0"
+    myh.overwrite(pxeloader, f"{tftproot}/pxelinux.0")
     myh.recursive_chmod(tftproot, 0o755)
 
     pxeconf = "/etc/pxe.conf"
@@ -359,14 +863,20 @@ def configure_server(iface, ipaddr, domain, pxetitle, utils, netboots):
         f.write("# tftpd base dir:\n")
         f.write(f"tftpdbase={tftproot}\n\n")
         f.write("# domain name:\n")
-        f.write(f"domain={domain}\n")
+        f.write(f"domain={domain}\n\n")
+        f.write("# choopsit/servers scripts:\n")
+        f.write(f"srcfolder={srcfolder}\n")
+        f.write(f"bootproto={bootproto}\n")
+        if multicast[0]:
+            f.write(f"mcast_port={mcastport}\n")
+            f.write(f"mcast_clients={multicast[3]}\n")
+            f.write(f"mcast_maxwait={multicast[4]}\n")
 
     if not os.path.isdir(f"{tftproot}/pxelinux.cfg"):
         os.makedirs(f"{tftproot}/pxelinux.cfg")
 
     pxebg = f"debian_bg.png"
-    shutil.copy(f"{srcfolder}/conf/pxe/{pxebg}",
-                f"{tftproot}/{pxebg}")
+    myh.overwrite(f"{srcfolder}/conf/pxe/{pxebg}", f"{tftproot}/{pxebg}")
 
     defaultf = f"{tftproot}/pxelinux.cfg/default"
     with open(defaultf, "w") as f:
@@ -399,11 +909,28 @@ def configure_server(iface, ipaddr, domain, pxetitle, utils, netboots):
     if utils != {}:
         menutitles.append("utilities")
 
-    for menutitle in menutitles:
-        generate_menu(menutitle, pxebg, pxetitle, netboots, utils)
-        with open(defaultf, "r") as f:
-            if f"pxelinux.cfg/{menutitle}" not in f.read():
-                add_menu_to_default(menutitle, defaultf)
+    with ThreadPoolExecutor(max_workers=maxdownloads) as pool:
+        downloads = {"install": start_downloads(pool, netboots,
+                                                fetch_netboot),
+                     "utilities": start_downloads(pool, utils,
+                                                  download_file)}
+
+        for menutitle in menutitles:
+            generate_menu(menutitle, pxebg, pxetitle, netboots, utils,
+                          downloads)
+            with open(defaultf, "r") as f:
+                if f"pxelinux.cfg/{menutitle}" not in f.read():
+                    add_menu_to_default(menutitle, defaultf)
+
+    if "clonezilla" in utils:
+        configure_nfs(nfsclients)
+
+    if autoinstall[0] and netboots != {}:
+        generate_preseeds(netboots, domain, autoinstall)
+
+    generate_hostconfigs(inventory, netboots, utils)
+
+    dedupe_tftproot()
 
     scriptfolder = f"{srcfolder}/conf/pxe/bin"
     for script in os.listdir(scriptfolder):
@@ -411,6 +938,9 @@ def configure_server(iface, ipaddr, domain, pxetitle, utils, netboots):
         if os.path.exists(target):
             os.remove(target)
         shutil.copy(f"{scriptfolder}/{script}", target)
+    myh.link_srcfolder()
+
+    configure_tftp(ipaddr, tftpserver)
 
     print(f"{done} PXE server ready to use")
 
@@ -435,12 +965,28 @@ gpartedlatest = "1.1.0-5"      # Check https://gparted.org/download.php
 memtestlatest = "5.31b"        # Check http://www.memtest.org
 utilities = ["clonezilla", "gparted", "memtest86+"]
 
+partimagfolder = "/home/partimag"
+mcastport = 2232
+nfsrwsize = 1048576
+nfsdefclients = 10
+nfsminthreads = 8
+nfsmaxthreads = 128
+czprofiles = {"zstd": ["zstd, multi-threaded", "-z9p"],
+              "pigz": ["gzip, multi-threaded", "-z1p"],
+              "pbzip2": ["bzip2, multi-threaded", "-z2p"]}
+
 ubuntults = "focal"
 netboots = ["debian stable", "ubuntu LTS"]
 
 tftproot = "/srv/tftp"
+dedupeindex = "/var/cache/servers/tftpdedupe.json"
+httpalias = "pxe"
+hostcfgmarker = "# Generated by pxe.py from the host inventory"
+nbdigestfile = ".netboot.sha256"
 
-currentpath = os.getcwd()
+maxdownloads = 4
+dlsegments = 4
+zipchunk = 1024 * 1024
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
@@ -459,9 +1005,28 @@ if __name__ == "__main__":
     myoldip, myip, renewip = myh.set_ipaddr(myiface)
 
     mytitle = set_pxetitle(mydomain)
-    refutilsdict = ref_utils(myip)
+    mybootproto = set_bootproto()
+    mytftpserver = set_tftpserver()
+    myinventoryfile, myinventory = set_inventory(mydomain)
+    myautoinstall = set_autoinstall()
+    refutilsdict = ref_utils(myip, mybootproto)
     myutils = choose_utils(utilities, refutilsdict)
-    refnetbootsdict = ref_netboots()
+    mymulticast = [False]
+    myczprofiles = []
+    mynfsclients = 0
+    if "clonezilla" in myutils:
+        myczprofiles = choose_czprofiles()
+        for myczprofile in myczprofiles:
+            myutils["clonezilla"][2] += czprofile_entry(myip, mybootproto,
+                                                        myczprofile)
+        mymulticast = set_multicast()
+        if mymulticast[0]:
+            myutils["clonezilla"][2] += multicast_entry(myip, mybootproto,
+                                                        mymulticast)
+            mynfsclients = set_nfsclients(mymulticast[3])
+        else:
+            mynfsclients = set_nfsclients(nfsdefclients)
+    refnetbootsdict = ref_netboots(myip, mybootproto, myautoinstall[0])
     mynetboots = choose_netboots(netboots, refnetbootsdict)
 
     print(f"\n{ci}Server settings{c0}:")
@@ -471,11 +1036,27 @@ if __name__ == "__main__":
         print(f"  - {ci}IP address{c0}: {myip}")
     print(f"{ci}PXE settings{c0}:")
     print(f"  - {ci}Title{c0}:      {mytitle}")
+    print(f"  - {ci}Boot files{c0}: {mybootproto}")
+    print(f"  - {ci}TFTP server{c0}: {mytftpserver}")
+    if myinventoryfile != "":
+        print(f"  - {ci}Host inventory{c0}: {myinventoryfile}")
+    if myautoinstall[0]:
+        mymirror = myautoinstall[1] or "official mirrors"
+        print(f"  - {ci}Unattended installs{c0}: from {mymirror}")
 
     if myutils != {}:
         print(f"  - {ci}Utilities{c0}:")
         for key, _ in myutils.items():
             print(f"    - {key}")
+    if myczprofiles != []:
+        print(f"  - {ci}Clonezilla image profiles{c0}: "
+              f"{', '.join(myczprofiles)}")
+    if mymulticast[0]:
+        print(f"  - {ci}Multicast restore{c0}: '{mymulticast[1]}' to "
+              f"{mymulticast[2]}, {mymulticast[3]} clients or "
+              f"{mymulticast[4]}s")
+    if mynfsclients > 0:
+        print(f"  - {ci}NFS clients{c0}: {mynfsclients}")
 
     if mynetboots != {}:
         print(f"  - {ci}Installers{c0}:")
@@ -490,8 +1071,15 @@ if __name__ == "__main__":
     if renewip:
         myh.fix_ip(myiface, myip, myoldip)
 
-    mypkgs = ["tftpd-hpa", "syslinux-utils", "syslinux", "pxelinux",
-              "nfs-kernel-server"]
+    mypkgs = ["syslinux-utils", "syslinux", "pxelinux", "nfs-kernel-server"]
+    if mytftpserver == "tftpd-hpa":
+        mypkgs.append("tftpd-hpa")
+    if mymulticast[0]:
+        mypkgs.append("udpcast")
+    if mybootproto == "http":
+        mypkgs.append("apache2")
     myh.install_server(mypkgs)
 
-    configure_server(myiface, myip, mydomain, mytitle, myutils, mynetboots)
+    configure_server(myiface, myip, mydomain, mytitle, myutils, mynetboots,
+                     mybootproto, mytftpserver, myinventory,
+                     myautoinstall, mymulticast, mynfsclients)
@@ -3,7 +3,6 @@
 import sys
 import re
 import os
-import urllib.request
 import _myhelpers_ as myh
 
 __description__ = "Install SaltStack minion on Debian"
@@ -57,7 +56,9 @@ def add_saltstack_repo():
     salturl = f"repo.saltstack.com/py3/debian/{debianstablev}/amd64/latest"
     keyurl = f"https://{salturl}/SALTSTACK-GPG-KEY.pub"
 
-    urllib.request.urlretrieve(keyurl, repokey)
+    if not myh.download(keyurl, repokey):
+        print(f"{error} Failed to get SaltStack repo key")
+        exit(1)
     os.system(f"apt-key add {repokey}")
 
     with open("/etc/apt/sources.list.d/saltstack.list", "w") as f: